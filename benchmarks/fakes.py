@@ -0,0 +1,528 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Letterboxd shows 100 films per list page
+LIST_PAGE_SIZE = 100
+
+PLEX_LIBRARY_ID = 1
+PLEX_COLLECTION_ID = 99999999
+PLEX_COLLECTION_TITLE = "Benchmark"
+PLEX_MACHINE_IDENTIFIER = "benchmark"
+
+LETTERBOXD_LIST = "/benchmark/list/films/"
+
+
+# Synthetic film n: Letterboxd id, slug and TMDB id (None for some films)
+def film(n):
+    return n, f"film-{n}", None if n % 100 == 0 else 100000 + n
+
+
+class FakeServer:
+    # (method, path pattern, endpoint label, handler name)
+    routes = ()
+
+    def __init__(self, latency=0):
+        self.latency = latency  # seconds added to every response
+        self.requests = Counter()  # endpoint, count
+        self.lock = threading.RLock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_requests(self):
+        with self.lock:
+            self.requests.clear()
+
+    # Route a request to its handler, counting it per endpoint
+    def dispatch(self, method, path, body):
+        url = urlparse(path)
+        query = {
+            key: values[0]
+            for key, values in parse_qs(url.query, keep_blank_values=True).items()
+        }
+
+        for route_method, pattern, label, handler in self.routes:
+            match = re.fullmatch(pattern, url.path)
+
+            if route_method == method and match:
+                with self.lock:
+                    self.requests[f"{method} {label}"] += 1
+
+                if self.latency:
+                    time.sleep(self.latency)
+
+                return getattr(self, handler)(query, body, *match.groups())
+
+        with self.lock:
+            self.requests[f"{method} unknown"] += 1
+
+        return 404, "Not found", "text/plain"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real services
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes, don't let them
+            # wait on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, method):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+
+                status, content, content_type = fake.dispatch(method, self.path, body)
+                content = content.encode()
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_PUT(self):
+                self._respond("PUT")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def do_DELETE(self):
+                self._respond("DELETE")
+
+        return Handler
+
+
+class FakePlex(FakeServer):
+    routes = (
+        ("GET", r"/identity", "/identity", "_identity"),
+        (
+            "GET",
+            r"/library/sections/(\d+)/all",
+            "/library/sections/{id}/all",
+            "_all",
+        ),
+        (
+            "GET",
+            r"/library/sections/(\d+)/collections",
+            "/library/sections/{id}/collections",
+            "_collections",
+        ),
+        (
+            "GET",
+            r"/library/metadata/(\d+)/matches",
+            "/library/metadata/{id}/matches",
+            "_matches",
+        ),
+        (
+            "GET",
+            r"/library/metadata/(\d+)/children",
+            "/library/metadata/{id}/children",
+            "_children",
+        ),
+        ("GET", r"/library/metadata/([\d,]+)", "/library/metadata/{ids}", "_metadata"),
+        (
+            "PUT",
+            r"/library/collections/(\d+)/items",
+            "/library/collections/{id}/items",
+            "_add_items",
+        ),
+        (
+            "PUT",
+            r"/library/collections/(\d+)/items/(\d+)/move",
+            "/library/collections/{id}/items/{id}/move",
+            "_move",
+        ),
+        (
+            "DELETE",
+            r"/library/collections/(\d+)/items/(\d+)",
+            "/library/collections/{id}/items/{id}",
+            "_remove",
+        ),
+    )
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+
+        self.clock = 1600000000  # bumped by every change
+        self.library = {}  # rating_key, (tmdb_id, updated_at)
+        self.by_tmdb_id = {}  # tmdb_id, rating_key
+        self.collection = []  # rating_key
+        self.collection_updated_at = self.clock
+
+    def _tick(self):
+        self.clock += 1
+
+        return self.clock
+
+    # Add movies to the library, new rating keys keep increasing like Plex's
+    def add_movies(self, tmdb_ids):
+        with self.lock:
+            updated_at = self._tick()
+
+            for tmdb_id in tmdb_ids:
+                if tmdb_id not in self.by_tmdb_id:
+                    rating_key = len(self.library) + 1
+                    self.library[rating_key] = (tmdb_id, updated_at)
+                    self.by_tmdb_id[tmdb_id] = rating_key
+
+    # TMDB ids of the collection, in order
+    def collection_tmdb_ids(self):
+        with self.lock:
+            return [self.library[rating_key][0] for rating_key in self.collection]
+
+    def _container(self, content, size, total=None):
+        total = size if total is None else total
+
+        return (
+            200,
+            f'<MediaContainer size="{size}" totalSize="{total}">{content}</MediaContainer>',
+            "text/xml",
+        )
+
+    def _videos(self, rating_keys, guids):
+        videos = []
+
+        for rating_key in rating_keys:
+            tmdb_id, updated_at = self.library[rating_key]
+            guid = f'<Guid id="tmdb://{tmdb_id}"/>' if guids else ""
+            videos.append(
+                f'<Video ratingKey="{rating_key}" guid="plex://movie/{tmdb_id}" title="tmdb-{tmdb_id}" '
+                f'addedAt="{updated_at}" updatedAt="{updated_at}">{guid}</Video>'
+            )
+
+        return "".join(videos)
+
+    # One page of rating keys, per the X-Plex-Container-* params
+    def _page(self, query, rating_keys, guids):
+        start = int(query.get("X-Plex-Container-Start", 0))
+        size = int(query.get("X-Plex-Container-Size", len(rating_keys)))
+
+        if "limit" in query:
+            size = min(size, int(query["limit"]))
+
+        page = rating_keys[start : start + size]
+
+        return self._container(self._videos(page, guids), len(page), len(rating_keys))
+
+    def _identity(self, query, body):
+        return (
+            200,
+            f'<MediaContainer machineIdentifier="{PLEX_MACHINE_IDENTIFIER}"/>',
+            "text/xml",
+        )
+
+    def _all(self, query, body, library_id):
+        with self.lock:
+            rating_keys = list(self.library)
+
+            if "guid" in query:
+                tmdb_id = int(query["guid"].rsplit("/", 1)[-1])
+                rating_key = self.by_tmdb_id.get(tmdb_id)
+                rating_keys = [] if rating_key is None else [rating_key]
+
+            if "updatedAt>>" in query:
+                since = int(query["updatedAt>>"])
+                rating_keys = [
+                    rating_key
+                    for rating_key in rating_keys
+                    if self.library[rating_key][1] > since
+                ]
+
+            return self._page(query, rating_keys, query.get("includeGuids") == "1")
+
+    def _collections(self, query, body, library_id):
+        if query.get("title", PLEX_COLLECTION_TITLE) != PLEX_COLLECTION_TITLE:
+            return self._container("", 0)
+
+        return self._container(
+            f'<Directory ratingKey="{PLEX_COLLECTION_ID}" title="{PLEX_COLLECTION_TITLE}"/>',
+            1,
+        )
+
+    # Plex searches its agents, so any TMDB id matches, in the library or not
+    def _matches(self, query, body, rating_key):
+        tmdb_id = query["title"][len("tmdb-") :]
+
+        return self._container(
+            f'<SearchResult guid="plex://movie/{tmdb_id}" name="tmdb-{tmdb_id}" score="100"/>',
+            1,
+        )
+
+    def _children(self, query, body, collection_id):
+        with self.lock:
+            return self._page(
+                query, list(self.collection), query.get("includeGuids") == "1"
+            )
+
+    def _metadata(self, query, body, rating_keys):
+        with self.lock:
+            if rating_keys == str(PLEX_COLLECTION_ID):
+                return self._container(
+                    f'<Directory ratingKey="{PLEX_COLLECTION_ID}" updatedAt="{self.collection_updated_at}" '
+                    f'childCount="{len(self.collection)}"/>',
+                    1,
+                )
+
+            existing = [
+                int(rating_key)
+                for rating_key in rating_keys.split(",")
+                if int(rating_key) in self.library
+            ]
+
+            if not existing:
+                return 404, "Not found", "text/plain"
+
+            return self._container(self._videos(existing, False), len(existing))
+
+    def _add_items(self, query, body, collection_id):
+        rating_keys = query["uri"].rsplit("/library/metadata/", 1)[-1].split(",")
+
+        with self.lock:
+            present = set(self.collection)
+
+            for rating_key in map(int, rating_keys):
+                if rating_key in self.library and rating_key not in present:
+                    self.collection.append(rating_key)
+                    present.add(rating_key)
+
+            self.collection_updated_at = self._tick()
+
+        return self._container("", 0)
+
+    def _move(self, query, body, collection_id, rating_key):
+        with self.lock:
+            self.collection.remove(int(rating_key))
+
+            after = query.get("after")
+            index = 0 if after is None else self.collection.index(int(after)) + 1
+
+            self.collection.insert(index, int(rating_key))
+            self.collection_updated_at = self._tick()
+
+        return self._container("", 0)
+
+    def _remove(self, query, body, collection_id, rating_key):
+        with self.lock:
+            self.collection.remove(int(rating_key))
+            self.collection_updated_at = self._tick()
+
+        return self._container("", 0)
+
+
+class FakeRadarr(FakeServer):
+    routes = (
+        ("GET", r"/api/v3/movie", "/api/v3/movie", "_get_movies"),
+        ("GET", r"/api/v3/qualityprofile", "/api/v3/qualityprofile", "_profiles"),
+        ("POST", r"/api/v3/movie", "/api/v3/movie", "_add_movie"),
+        ("POST", r"/api/v3/movie/import", "/api/v3/movie/import", "_import"),
+    )
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+
+        self.movies = {}  # tmdb_id, movie
+
+    def add_movies(self, tmdb_ids):
+        with self.lock:
+            for tmdb_id in tmdb_ids:
+                self.movies.setdefault(
+                    tmdb_id,
+                    {"id": len(self.movies) + 1, "tmdbId": tmdb_id},
+                )
+
+    def _json(self, data, status=200):
+        return status, json.dumps(data), "application/json"
+
+    def _get_movies(self, query, body):
+        with self.lock:
+            if "tmdbId" in query:
+                movie = self.movies.get(int(query["tmdbId"]))
+
+                return self._json([] if movie is None else [movie])
+
+            return self._json(list(self.movies.values()))
+
+    def _profiles(self, query, body):
+        return self._json([{"id": 1, "name": "Any"}])
+
+    def _add_movie(self, query, body):
+        tmdb_id = json.loads(body)["tmdbId"]
+
+        with self.lock:
+            if tmdb_id in self.movies:
+                return self._json([{"errorMessage": "Movie already added"}], 400)
+
+            self.add_movies([tmdb_id])
+
+            return self._json(self.movies[tmdb_id], 201)
+
+    def _import(self, query, body):
+        tmdb_ids = [movie["tmdbId"] for movie in json.loads(body)]
+
+        with self.lock:
+            self.add_movies(tmdb_ids)
+
+            return self._json([self.movies[tmdb_id] for tmdb_id in tmdb_ids])
+
+
+class FakeLetterboxd(FakeServer):
+    routes = (
+        (
+            "GET",
+            r"/([\w-]+)/list/([\w-]+)/(?:page/(\d+)/)?",
+            "/{user}/list/{list}/page/{n}/",
+            "_list_page",
+        ),
+        ("GET", r"/film/([\w-]+)/?", "/film/{slug}/", "_film"),
+    )
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+
+        self.films = []  # film n, in list order
+
+    def _list_page(self, query, body, user, list_name, page):
+        page = int(page or 1)
+
+        with self.lock:
+            page_count = max(1, -(-len(self.films) // LIST_PAGE_SIZE))
+            films = self.films[(page - 1) * LIST_PAGE_SIZE : page * LIST_PAGE_SIZE]
+
+        if page > page_count:
+            return 404, "Not found", "text/html"
+
+        posters = "".join(
+            f'<li class="poster-container"><div class="film-poster" data-film-id="{film_id}" '
+            f'data-item-slug="{slug}"></div></li>'
+            for film_id, slug, tmdb_id in map(film, films)
+        )
+
+        # Letterboxd links the first, last and neighbouring pages
+        links = "".join(
+            (
+                f"<li><span>{n}</span></li>"
+                if n == page
+                else f'<li><a href="page/{n}/">{n}</a></li>'
+            )
+            for n in sorted({1, page - 1, page, page + 1, page_count})
+            if 1 <= n <= page_count
+        )
+        next_link = '<a class="next" href="next/">Next</a>' if page < page_count else ""
+
+        return (
+            200,
+            f'<html><body><section class="col-main"><ul class="poster-list poster-grid">{posters}</ul>'
+            f'<div class="pagination"><div class="paginate-pages"><ul>{links}</ul></div>{next_link}</div>'
+            "</section></body></html>",
+            "text/html",
+        )
+
+    def _film(self, query, body, slug):
+        film_id, slug, tmdb_id = film(int(slug[len("film-") :]))
+        return (
+            200,
+            f'<html><body class="film" data-tmdb-id="{tmdb_id or ""}"><h1>{slug}</h1></body></html>',
+            "text/html",
+        )
+
+
+# Plex, Radarr and Letterboxd stand-ins sharing one synthetic catalog.
+# The list holds films 1 to size; 9 in 10 are in the Plex library along with
+# size / 5 films outside the list, 1 in 20 is already in Radarr and
+# 1 in 100 has no TMDB id. Latency is added to every response, as over a
+# real network.
+class FakeServices:
+    def __init__(self, size, seed=0, latency=0):
+        self.random = random.Random(seed)
+        self.next_film = 1
+
+        self.plex = FakePlex(latency).start()
+        self.radarr = FakeRadarr(latency).start()
+        self.letterboxd = FakeLetterboxd(latency).start()
+
+        self.letterboxd.films = self._new_films(size)
+        self.plex.add_movies(
+            film(n)[2]
+            for n in range(self.next_film, self.next_film + size // 5)
+            if film(n)[2]
+        )
+        self.next_film += size // 5
+
+    # Create films, putting them in Plex and Radarr per the catalog ratios
+    def _new_films(self, count):
+        films = list(range(self.next_film, self.next_film + count))
+        self.next_film += count
+
+        self.plex.add_movies(film(n)[2] for n in films if film(n)[2] and n % 10)
+        self.radarr.add_movies(film(n)[2] for n in films if film(n)[2] and n % 20 == 0)
+
+        return films
+
+    def stop(self):
+        for server in (self.plex, self.radarr, self.letterboxd):
+            server.stop()
+
+    def reset_requests(self):
+        for server in (self.plex, self.radarr, self.letterboxd):
+            server.reset_requests()
+
+    # Requests per endpoint since the last reset, prefixed by service
+    def requests(self):
+        return {
+            f"{name} {endpoint}": count
+            for name, server in (
+                ("plex", self.plex),
+                ("radarr", self.radarr),
+                ("letterboxd", self.letterboxd),
+            )
+            for endpoint, count in sorted(server.requests.items())
+        }
+
+    # Reorder the whole list
+    def shuffle_list(self):
+        with self.letterboxd.lock:
+            self.random.shuffle(self.letterboxd.films)
+
+    # Insert new films at random positions in the list
+    def add_to_list(self, count):
+        films = self._new_films(count)
+
+        with self.letterboxd.lock:
+            for n in films:
+                self.letterboxd.films.insert(
+                    self.random.randint(0, len(self.letterboxd.films)), n
+                )
+
+    # TMDB ids the Plex collection should hold after a sync, in order
+    def expected_collection(self):
+        with self.letterboxd.lock:
+            tmdb_ids = [film(n)[2] for n in self.letterboxd.films]
+
+        return [tmdb_id for tmdb_id in tmdb_ids if tmdb_id in self.plex.by_tmdb_id]
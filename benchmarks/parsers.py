@@ -0,0 +1,216 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+from moviesync.letterboxd import _parse_film_page, _parse_list_page
+
+logger = logging.getLogger(__name__)
+
+
+# The BeautifulSoup parsers the targeted ones replaced, kept to compare with
+def _soup_list_page(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+
+    section = soup.find("section", {"class": "col-main"})
+
+    items = [
+        (int(div["data-film-id"]), div["data-item-slug"])
+        for div in section.find_all("div", {"data-film-id": True})
+    ]
+
+    pages = [
+        int(a.get_text(strip=True))
+        for a in soup.select(".paginate-pages a, .paginate-pages span")
+        if a.get_text(strip=True).isdigit()
+    ]
+
+    return items, max(pages, default=1), soup.select_one("a.next") is not None
+
+
+def _soup_film_page(html):
+    from bs4 import BeautifulSoup
+
+    body = BeautifulSoup(html, "lxml").find("body")
+
+    str_tmdb_id = body.get("data-tmdb-id") if body else None
+
+    return int(str_tmdb_id) if str_tmdb_id else None
+
+
+PARSERS = {
+    "list": (_soup_list_page, _parse_list_page),
+    "film": (_soup_film_page, _parse_film_page),
+}
+
+
+# Roughly the bulk of a real page around the parts that are read: head,
+# scripts, navigation and a sidebar of other lists' posters
+def _padding(n):
+    scripts = "".join(
+        f"<script>window.data{i} = {{{', '.join(f'k{j}: {j}' for j in range(40))}}};</script>"
+        for i in range(20)
+    )
+    nav = "".join(
+        f'<li class="nav-item"><a href="/section/{i}/" class="link">Section {i}</a></li>'
+        for i in range(60)
+    )
+    sidebar = "".join(
+        f'<li><div class="film-poster" data-film-id="{900000 + n + i}" data-item-slug="other-{i}">'
+        f'<img src="/poster/{i}.jpg" alt="Other {i}" width="70" height="105"></div></li>'
+        for i in range(24)
+    )
+
+    return (
+        f'<head><meta charset="utf-8"><title>Page {n}</title>{scripts}</head>',
+        f'<header><nav><ul class="main-nav">{nav}</ul></nav></header>',
+        f'<aside class="sidebar"><h2>Cloned from</h2><ul>{sidebar}</ul></aside>',
+    )
+
+
+# Synthetic pages shaped like Letterboxd's, when no saved pages are given
+def _synthetic_pages(count):
+    pages = []
+
+    for n in range(1, count + 1):
+        head, header, sidebar = _padding(n)
+
+        posters = "".join(
+            f'<li class="poster-container"><div class="really-lazy-load poster film-poster" '
+            f'data-film-id="{n * 100 + i}" data-item-slug="film-{n * 100 + i}" '
+            f'data-poster-url="/film/film-{n * 100 + i}/image-150/">'
+            f'<img src="/empty.png" class="image" width="150" height="225" alt="Film {i}"></div></li>'
+            for i in range(100)
+        )
+        links = "".join(f'<li><a href="page/{i}/">{i}</a></li>' for i in (1, 2, 3, 50))
+
+        pages.append(
+            (
+                "list",
+                f"synthetic/list/{n}",
+                f'<!DOCTYPE html><html lang="en">{head}<body class="list-page">{header}'
+                f'<div id="content"><section class="section col-main">'
+                f'<ul class="poster-list -p150 -grid poster-grid">{posters}</ul>'
+                f'<div class="pagination"><div class="paginate-pages"><ul>{links}</ul></div>'
+                f'<a class="next" href="page/2/">Next</a></div></section>{sidebar}</div></body></html>',
+            )
+        )
+
+        tmdb_id = "" if n % 10 == 0 else 100000 + n
+        pages.append(
+            (
+                "film",
+                f"synthetic/film/{n}",
+                f'<!DOCTYPE html><html lang="en">{head}'
+                f'<body class="film backdropped" data-tmdb-id="{tmdb_id}" data-tmdb-type="movie">'
+                f'{header}<div id="content"><h1>Film {n}</h1>'
+                f'<p class="synopsis">{"A film about something. " * 40}</p></div>{sidebar}</body></html>',
+            )
+        )
+
+    return pages
+
+
+# Saved pages under path, list pages told apart by their poster grid
+def _saved_pages(path):
+    pages = []
+
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if not name.endswith((".html", ".htm")):
+                continue
+
+            with open(os.path.join(root, name), "r", encoding="utf-8") as page_file:
+                html = page_file.read()
+
+            kind = "list" if "poster-grid" in html else "film"
+            pages.append((kind, os.path.relpath(os.path.join(root, name), path), html))
+
+    return pages
+
+
+# Best of repeat runs of parse over html, in milliseconds
+def _time(parse, html, repeat):
+    best = None
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(html)
+        duration = (time.perf_counter() - started) * 1000
+        best = duration if best is None else min(best, duration)
+
+    return best
+
+
+# python -m benchmarks.parsers [saved pages directory] [--repeat 5]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "pages",
+        nargs="?",
+        help="directory of Letterboxd list and film pages saved as .html",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=10,
+        help="synthetic pages of each kind when no directory is given",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        logger.error(
+            "Comparing with BeautifulSoup needs it, pip install beautifulsoup4"
+        )
+        sys.exit(1)  # error
+
+    pages = _saved_pages(args.pages) if args.pages else _synthetic_pages(args.synthetic)
+
+    if not pages:
+        logger.error(f"No .html pages found in {args.pages}")
+        sys.exit(1)  # error
+
+    print(
+        f"{'page':<40}{'size (KB)':>12}{'soup (ms)':>12}{'targeted (ms)':>16}{'speedup':>10}"
+    )
+
+    totals = {kind: [0.0, 0.0] for kind in PARSERS}
+    mismatches = []
+
+    for kind, name, html in pages:
+        soup_parse, targeted_parse = PARSERS[kind]
+
+        if soup_parse(html) != targeted_parse(html):
+            mismatches.append(name)
+
+        soup_time = _time(soup_parse, html, args.repeat)
+        targeted_time = _time(targeted_parse, html, args.repeat)
+
+        totals[kind][0] += soup_time
+        totals[kind][1] += targeted_time
+
+        print(
+            f"{name[-40:]:<40}{len(html) / 1024:>12.0f}{soup_time:>12.2f}{targeted_time:>16.2f}"
+            f"{soup_time / targeted_time:>9.1f}x"
+        )
+
+    for kind, (soup_time, targeted_time) in totals.items():
+        if targeted_time:
+            logger.info(
+                f"{kind} pages: soup {soup_time:.1f}ms, targeted {targeted_time:.1f}ms, "
+                f"{soup_time / targeted_time:.1f}x faster"
+            )
+
+    if mismatches:
+        for name in mismatches:
+            logger.error(f"Parsers disagree on {name}")
+
+        sys.exit(1)  # error
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import (
+    LETTERBOXD_LIST,
+    PLEX_COLLECTION_TITLE,
+    PLEX_LIBRARY_ID,
+    FakeServices,
+)
+
+logger = logging.getLogger(__name__)
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Run in this order, each one on the cache and services left by the previous
+SCENARIOS = ("cold", "warm", "reorder", "add")
+
+
+def _config(services, path):
+    return {
+        "plex": {
+            "url": services.plex.url,
+            "token": "benchmark",
+            "movie_library_id": PLEX_LIBRARY_ID,
+            "page_size": 1000,
+            "library_index_ttl": 300,
+            "validate_batch_size": 500,
+        },
+        "radarr": {
+            "url": services.radarr.url,
+            "apikey": "benchmark",
+            "quality_profile": "Any",
+            "root_folder_path": "/movies",
+            "library_ttl": 3600,
+            "batch_size": 50,
+        },
+        "letterboxd": {
+            "base_url": services.letterboxd.url,
+            "tabs": 4,
+            "connections": 8,
+            "timeout": 30,
+            "snapshot_max_age": 86400,
+            # The fake never throttles, measure the sync rather than the pacing
+            "rate": 10000,
+            "max_rate": 10000,
+        },
+        "http": {
+            "timeout": 30,
+            "retries": 3,
+            "backoff": 0.5,
+            "pool_size": 10,
+            "concurrency": 8,
+        },
+        "cache": {"path": os.path.join(path, "moviesync.cache")},
+        "sync": {"full_sync_interval": 86400},
+    }
+
+
+# Sync the benchmark list once, in a fresh process like sync.py
+def _sync(config, force, results):
+    from moviesync.cache import Cache
+    from moviesync.client import HttpClient
+    from moviesync.letterboxd import Letterboxd
+    from moviesync.letterboxdexport import LetterboxdExport
+    from moviesync.metrics import metrics
+    from moviesync.plex import Plex, plex_targets
+    from moviesync.radarr import Radarr
+
+    logging.basicConfig(level=logging.WARNING)
+
+    cache = Cache(config)
+    letterboxd = Letterboxd(config, cache)
+    client = HttpClient(config)
+    plexes = {
+        target: Plex(config, cache, client, target) for target in plex_targets(config)
+    }
+    radarr = Radarr(config, client, cache)
+
+    letterboxdexport = LetterboxdExport(letterboxd, plexes, radarr, cache, config)
+
+    async def run():
+        try:
+            await letterboxdexport.to_plex(
+                LETTERBOXD_LIST, PLEX_COLLECTION_TITLE, force
+            )
+        finally:
+            await letterboxd.close()
+
+    started = time.perf_counter()
+    success = True
+
+    try:
+        asyncio.run(run())
+    except Exception as err:
+        logger.error(f"Benchmark sync failed, exception: {err}")
+        success = False
+    finally:
+        client.close()
+        cache.close()
+
+    results.put(
+        {
+            "success": success,
+            "wall_time": time.perf_counter() - started,
+            # Kilobytes on Linux
+            "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "stages": metrics.report()["stages"],
+            "startup": metrics.first_request(config["plex"]["url"]),
+        }
+    )
+
+
+def _run_scenario(context, services, config, force):
+    services.reset_requests()
+
+    results = context.Queue()
+    process = context.Process(target=_sync, args=(config, force, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    result["correct"] = (
+        services.plex.collection_tmdb_ids() == services.expected_collection()
+    )
+    result["requests"] = services.requests()
+    result["total_requests"] = sum(result["requests"].values())
+
+    return result
+
+
+# Run every scenario against a synthetic list and library of size films
+def run_size(context, size, latency):
+    results = {}
+    services = FakeServices(size, latency=latency)
+    # Only comparable with runs at the same latency
+    suffix = f"@{latency * 1000:g}ms" if latency else ""
+
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            config = _config(services, path)
+
+            for scenario in SCENARIOS:
+                if scenario == "reorder":
+                    services.shuffle_list()
+                elif scenario == "add":
+                    services.add_to_list(size // 2)
+
+                # Unchanged list and collection, sync anyway
+                force = scenario == "warm"
+
+                results[f"{scenario}/{size}{suffix}"] = result = _run_scenario(
+                    context, services, config, force
+                )
+
+                logger.info(
+                    f"{scenario}/{size}{suffix}: {result['wall_time']:.2f}s, {result['total_requests']} request(s), "
+                    f"{result['peak_memory']:.0f} MB, first Plex request after {result['startup'] or 0:.2f}s{'' if result['correct'] else ', WRONG collection'}"
+                )
+    finally:
+        services.stop()
+
+    return results
+
+
+# Compare results with the baseline, returns the regressions found.
+# Request counts are deterministic, any increase is a regression.
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    print(
+        f"{'scenario':<16}{'wall time (s)':>22}{'requests':>20}{'peak memory (MB)':>24}"
+    )
+
+    for name, result in results.items():
+        base = baseline.get(name)
+
+        if not result["success"] or not result["correct"]:
+            regressions.append(f"{name}: sync failed or collection is wrong")
+
+        if base is None:
+            print(
+                f"{name:<16}{result['wall_time']:>22.2f}{result['total_requests']:>20}{result['peak_memory']:>24.0f}"
+            )
+            continue
+
+        def column(key, fmt):
+            change = (result[key] - base[key]) / base[key] if base[key] else 0
+
+            return f"{result[key]:{fmt}} ({change:+.0%})"
+
+        print(
+            f"{name:<16}{column('wall_time', '.2f'):>22}{column('total_requests', 'd'):>20}"
+            f"{column('peak_memory', '.0f'):>24}"
+        )
+
+        if result["total_requests"] > base["total_requests"]:
+            endpoints = [
+                f"{endpoint} {base['requests'].get(endpoint, 0)} -> {count}"
+                for endpoint, count in result["requests"].items()
+                if count > base["requests"].get(endpoint, 0)
+            ]
+            regressions.append(f"{name}: more requests, {', '.join(endpoints)}")
+
+        # Some slack too, small runs are noisy
+        for key, slack in (("wall_time", 0.1), ("peak_memory", 5)):
+            if result[key] > base[key] * (1 + tolerance) + slack:
+                regressions.append(
+                    f"{name}: {key} {base[key]:.2f} -> {result[key]:.2f}"
+                )
+
+    return regressions
+
+
+# python -m benchmarks.run [--sizes 100 1000 ...] [--save-baseline]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000],
+        help="number of films in the list, 100 to 50000",
+    )
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed wall time and memory increase over the baseline",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="seconds the fake services take to respond, eg 0.02",
+    )
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # A fresh interpreter per sync, nothing warm but the cache
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+
+    for size in args.sizes:
+        results.update(run_size(context, size, args.latency))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+    baseline = {}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline.update(results)
+
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=4)
+
+        logger.info(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+
+        sys.exit(1)  # error
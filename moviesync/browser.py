@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from moviesync.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Virtual display for a headed browser when there is none
+XVFB_DISPLAY = ":99"
+
+
+class BrowserPool:
+    def __init__(self, size, headless=False):
+        self.size = max(1, size)
+        self.headless = headless
+        self.browser = None
+        self.tabs = None
+        self.xvfb = None
+        self.lock = asyncio.Lock()
+
+    # Start Xvfb for a headed browser, unless there already is a display
+    async def _start_display(self):
+        if self.headless or os.environ.get("DISPLAY") or not shutil.which("Xvfb"):
+            return
+
+        logger.debug(f"Starting Xvfb on display {XVFB_DISPLAY}")
+
+        # Left behind by a previous container run
+        number = XVFB_DISPLAY.lstrip(":")
+        try:
+            os.remove(f"/tmp/.X{number}-lock")
+        except FileNotFoundError:
+            pass
+
+        self.xvfb = subprocess.Popen(
+            ["Xvfb", XVFB_DISPLAY, "-screen", "0", "1280x720x16"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        os.environ["DISPLAY"] = XVFB_DISPLAY
+
+        # Wait for the display socket
+        for i in range(50):
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                break
+
+            await asyncio.sleep(0.1)
+
+    def _stop_display(self):
+        if self.xvfb is None:
+            return
+
+        logger.debug("Stopping Xvfb")
+
+        self.xvfb.terminate()
+        self.xvfb.wait()
+        self.xvfb = None
+        del os.environ["DISPLAY"]
+
+    # Start the shared browser and open the pool of tabs
+    async def _start(self):
+        async with self.lock:
+            if self.browser is not None:
+                return
+
+            logger.debug(
+                f"Starting {'headless ' if self.headless else ''}browser with {self.size} tab(s)"
+            )
+
+            # Only runs that need the browser pay for importing it
+            import zendriver as zd
+
+            await self._start_display()
+
+            self.browser = await zd.start(headless=self.headless, no_sandbox=True)
+            self.tabs = asyncio.Queue()
+
+            for i in range(self.size):
+                self.tabs.put_nowait(await self._new_tab())
+
+    async def _new_tab(self):
+        return await self.browser.get("about:blank", new_tab=True)
+
+    # Close a failed tab and replace it with a fresh one
+    async def _recycle(self, tab):
+        logger.debug("Recycling browser tab")
+
+        try:
+            await tab.close()
+        except Exception as err:
+            logger.debug(f"Unable to close browser tab, exception: {err}")
+
+        return await self._new_tab()
+
+    # Borrow a tab from the pool, starting the browser on first use
+    async def acquire(self):
+        if self.browser is None:
+            await self._start()
+
+        return await self.tabs.get()
+
+    # Return a tab to the pool, replacing it if it failed
+    async def release(self, tab, failed=False):
+        if failed:
+            try:
+                tab = await self._recycle(tab)
+            except Exception as err:
+                logger.error(
+                    f"Unable to open replacement browser tab, exception: {err}"
+                )
+                # Keep the pool at full size, the next user retries the broken tab
+        self.tabs.put_nowait(tab)
+
+    # Load a url in a pooled tab and return the page content, and whether
+    # waiting for wait_element timed out
+    async def get_content(self, url, wait_element):
+        tab = await self.acquire()
+        failed = False
+        timed_out = False
+        started = time.perf_counter()
+
+        try:
+            await tab.get(url)
+
+            try:
+                await tab.select(wait_element)
+            except asyncio.TimeoutError as err:
+                logger.error(f"Timed out waiting for page to load: {err}")
+                timed_out = True
+            except Exception as err:
+                logger.error(f"Error waiting for page to load: {err}")
+
+            return await tab.get_content(), timed_out
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.observe_browser_page_load(time.perf_counter() - started)
+
+            await self.release(tab, failed)
+
+    # Stop the shared browser
+    async def stop(self):
+        async with self.lock:
+            if self.browser is None:
+                return
+
+            logger.debug("Stopping browser")
+
+            try:
+                await self.browser.stop()
+            except Exception as err:
+                logger.error(f"Unable to stop browser, exception: {err}")
+
+            self.browser = None
+            self.tabs = None
+
+            self._stop_display()
@@ -1,102 +1,618 @@
+import json
 import logging
 import sqlite3
+import threading
+import time
 from contextlib import closing
 
+from moviesync.metrics import metrics
+
 logger = logging.getLogger(__name__)
 
+# Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds
+BATCH_SIZE = 500
+
+# Tables keyed per Plex library
+LIBRARY_TABLES = ("plex_library", "plex_library_state", "sync_state", "sync_journal", "sync_journal_entry")
+
+
+def _chunks(values, size=BATCH_SIZE):
+    values = list(values)
+
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
 
 class Cache:
-    def __init__(self):
-        self.path = "db/moviesync.cache"
-
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    "SELECT COUNT(name) FROM sqlite_master WHERE type='table' AND name='id_map'"
-                )
-                if cursor.fetchone()[0] == 0:
-                    logger.debug(f"Initializing cache database at {self.path}")
-                else:
-                    logger.debug(f"Using cache database at {self.path}")
-
-                # cursor.execute("DROP TABLE IF EXISTS id_map")
-
-                cursor.execute(
-                    """CREATE TABLE IF NOT EXISTS id_map (
-                    tmdb_id         INTEGER PRIMARY KEY,
-                    letterboxd_id   INTEGER,
-                    plex_id         INTEGER)"""
-                )
+    def __init__(self, config):
+        cache_config = config.get("cache", {})
+
+        self.path = cache_config.get("path", "db/moviesync.cache")
+        # Seconds a negative result is trusted, and how many are kept at most
+        self.negative_ttl = cache_config.get("negative_ttl", 86400)
+        self.negative_max_entries = cache_config.get("negative_max_entries", 100000)
+
+        # One connection per process, shared by all queries
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT COUNT(name) FROM sqlite_master WHERE type='table' AND name='id_map'"
+            )
+            if cursor.fetchone()[0] == 0:
+                logger.debug(f"Initializing cache database at {self.path}")
+            else:
+                logger.debug(f"Using cache database at {self.path}")
+
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+
+            # cursor.execute("DROP TABLE IF EXISTS id_map")
+
+            # Tables from before Plex targets were keyed by library id or
+            # collection id alone, rebuild them keyed by library url too
+            for table in LIBRARY_TABLES:
+                cursor.execute(f"PRAGMA table_info({table})")
+                columns = [row["name"] for row in cursor.fetchall()]
+
+                if columns and "library" not in columns:
+                    logger.debug(f"Rebuilding cache table {table} per Plex library")
+                    cursor.execute(f"DROP TABLE {table}")
+
+            # Plex ids per library, eg http://plex:32400/library/sections/1, so
+            # targets on other servers or libraries keep their own
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS plex_map (
+                library         TEXT,
+                tmdb_id         INTEGER,
+                plex_id         INTEGER,
+                PRIMARY KEY (library, tmdb_id))"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS plex_map_plex_id ON plex_map(library, plex_id)"
+            )
+
+            self._migrate_id_map(cursor, config.get("plex", {}))
+
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS id_map (
+                tmdb_id         INTEGER PRIMARY KEY,
+                letterboxd_id   INTEGER)"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS id_map_letterboxd_id ON id_map(letterboxd_id)"
+            )
+
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS uri_map (
+                uri             TEXT PRIMARY KEY,
+                tmdb_id         INTEGER)"""
+            )
+
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS plex_library (
+                library         TEXT,
+                rating_key      INTEGER,
+                tmdb_id         INTEGER,
+                updated_at      INTEGER,
+                PRIMARY KEY (library, rating_key))"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS plex_library_tmdb_id ON plex_library(library, tmdb_id)"
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS sync_state (
+                letterboxd_list         TEXT,
+                library                 TEXT,
+                collection_id           INTEGER,
+                letterboxd_fingerprint  TEXT,
+                plex_updated_at         INTEGER,
+                plex_child_count        INTEGER,
+                synced_at               INTEGER,
+                PRIMARY KEY (letterboxd_list, library, collection_id))"""
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS list_snapshot (
+                letterboxd_list TEXT PRIMARY KEY,
+                items           TEXT,
+                page_hashes     TEXT,
+                crawled_at      INTEGER)"""
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS radarr_library (
+                url             TEXT PRIMARY KEY,
+                tmdb_ids        TEXT,
+                loaded_at       INTEGER)"""
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS plex_library_state (
+                library         TEXT PRIMARY KEY,
+                updated_at      INTEGER)"""
+            )
+            self._migrate_negative_cache(cursor)
+
+            # key has no type, it holds TMDB and Letterboxd ids as well as
+            # data export uris
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS negative_cache (
+                kind            TEXT,
+                key,
+                expires_at      INTEGER,
+                PRIMARY KEY (kind, key))"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS negative_cache_expires_at ON negative_cache(expires_at)"
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS sync_journal (
+                letterboxd_list TEXT,
+                library         TEXT,
+                collection_id   INTEGER,
+                version         INTEGER,
+                fingerprint     TEXT,
+                started_at      INTEGER,
+                PRIMARY KEY (letterboxd_list, library, collection_id))"""
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS sync_journal_entry (
+                letterboxd_list TEXT,
+                library         TEXT,
+                collection_id   INTEGER,
+                kind            TEXT,
+                key             INTEGER,
+                value           TEXT,
+                PRIMARY KEY (letterboxd_list, library, collection_id, kind, key))"""
+            )
+
+        self.evict_negatives()
+
+    # Close the shared connection
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # id_map kept one Plex id per TMDB id before Plex targets. Move them to
+    # plex_map as ids of the default target's library, same url as
+    # Plex.library, and rebuild id_map without them.
+    def _migrate_id_map(self, cursor, plex_config):
+        cursor.execute("PRAGMA table_info(id_map)")
+
+        if "plex_id" not in [row["name"] for row in cursor.fetchall()]:
+            return
+
+        if plex_config.get("url") and plex_config.get("movie_library_id"):
+            library = f"{plex_config['url'].rstrip('/')}/library/sections/{plex_config['movie_library_id']}"
+
+            cursor.execute(
+                """INSERT OR IGNORE INTO plex_map(library, tmdb_id, plex_id)
+                SELECT ?, tmdb_id, plex_id FROM id_map WHERE plex_id IS NOT NULL""",
+                (library,),
+            )
+            logger.debug(f"Moved {cursor.rowcount} cached Plex id(s) to {library}")
+
+        cursor.execute("DROP INDEX IF EXISTS id_map_plex_id")
+        cursor.execute("DROP INDEX IF EXISTS id_map_letterboxd_id")
+        cursor.execute("ALTER TABLE id_map RENAME TO id_map_old")
+        cursor.execute(
+            """CREATE TABLE id_map (
+            tmdb_id         INTEGER PRIMARY KEY,
+            letterboxd_id   INTEGER)"""
+        )
+        cursor.execute(
+            """INSERT INTO id_map(tmdb_id, letterboxd_id)
+            SELECT tmdb_id, letterboxd_id FROM id_map_old
+            WHERE letterboxd_id IS NOT NULL"""
+        )
+        cursor.execute("DROP TABLE id_map_old")
+
+    # negative_cache.key was declared INTEGER while also holding uris, rebuild
+    # it without a type. Values keep their storage class when copied.
+    def _migrate_negative_cache(self, cursor):
+        cursor.execute("PRAGMA table_info(negative_cache)")
+
+        types = {row["name"]: row["type"] for row in cursor.fetchall()}
+
+        if types.get("key") != "INTEGER":
+            return
+
+        cursor.execute("DROP INDEX IF EXISTS negative_cache_expires_at")
+        cursor.execute("ALTER TABLE negative_cache RENAME TO negative_cache_old")
+        cursor.execute(
+            """CREATE TABLE negative_cache (
+            kind            TEXT,
+            key,
+            expires_at      INTEGER,
+            PRIMARY KEY (kind, key))"""
+        )
+        cursor.execute(
+            """INSERT INTO negative_cache(kind, key, expires_at)
+            SELECT kind, key, expires_at FROM negative_cache_old"""
+        )
+        cursor.execute("DROP TABLE negative_cache_old")
+
+    # Run a SELECT ... IN (...) query in chunks and return all rows,
+    # params are bound before the IN values
+    def _query_in(self, query, values, params=()):
+        rows = []
+
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            for chunk in _chunks(values):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(query.format(placeholders), (*params, *chunk))
+                rows.extend(cursor.fetchall())
+
+        return rows
+
+    # Add many items to cache in one transaction, as (tmdb_id, letterboxd_id)
+    def add_id_maps(self, id_maps):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO id_map(tmdb_id, letterboxd_id) VALUES(?, ?)",
+                id_maps,
+            )
+
+    # Find cached items by Letterboxd ids, returns {letterboxd_id: tmdb_id}
+    def query_id_maps_by_letterboxd(self, letterboxd_ids):
+        letterboxd_ids = set(letterboxd_ids)
+        rows = self._query_in(
+            "SELECT tmdb_id, letterboxd_id FROM id_map WHERE letterboxd_id IN ({})",
+            letterboxd_ids,
+        )
+
+        id_maps = {row["letterboxd_id"]: row["tmdb_id"] for row in rows}
+        metrics.cache_lookups("query_id_maps_by_letterboxd", letterboxd_ids, id_maps)
+
+        return id_maps
+
+    # Add Plex ids of TMDB ids in a library, in one transaction
+    def add_plex_maps(self, library, plex_maps):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO plex_map(library, tmdb_id, plex_id) VALUES(?, ?, ?)",
+                [(library, tmdb_id, plex_id) for tmdb_id, plex_id in plex_maps],
+            )
+
+    # Find cached Plex ids in a library by TMDB ids, returns {tmdb_id: plex_id}
+    def query_plex_maps(self, library, tmdb_ids):
+        tmdb_ids = set(tmdb_ids)
+        rows = self._query_in(
+            "SELECT tmdb_id, plex_id FROM plex_map WHERE library = ? AND tmdb_id IN ({})",
+            tmdb_ids,
+            (library,),
+        )
+
+        plex_maps = {row["tmdb_id"]: row["plex_id"] for row in rows}
+        metrics.cache_lookups("query_plex_maps", tmdb_ids, plex_maps)
 
-    # Add item to cache
-    def add_id_map(self, tmdb_id, letterboxd_id, plex_id):
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    f"INSERT OR IGNORE INTO id_map(tmdb_id) VALUES(?)", (tmdb_id,)
+        return plex_maps
+
+    # Find cached TMDB ids in a library by Plex ids, returns {plex_id: tmdb_id}
+    def query_plex_maps_by_plex(self, library, plex_ids):
+        plex_ids = set(plex_ids)
+        rows = self._query_in(
+            "SELECT tmdb_id, plex_id FROM plex_map WHERE library = ? AND plex_id IN ({})",
+            plex_ids,
+            (library,),
+        )
+
+        plex_maps = {row["plex_id"]: row["tmdb_id"] for row in rows}
+        metrics.cache_lookups("query_plex_maps_by_plex", plex_ids, plex_maps)
+
+        return plex_maps
+
+    # Forget the Plex ids of TMDB ids in a library, in one transaction
+    def remove_plex_maps(self, library, tmdb_ids):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "DELETE FROM plex_map WHERE library = ? AND tmdb_id = ?",
+                [(library, tmdb_id) for tmdb_id in tmdb_ids],
+            )
+
+    # Add Letterboxd uris of data exports with their TMDB id, in one transaction
+    def add_uri_maps(self, uri_maps):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO uri_map(uri, tmdb_id) VALUES(?, ?)", uri_maps
+            )
+
+    # Find cached Letterboxd uris, returns {uri: tmdb_id}
+    def query_uri_maps(self, uris):
+        uris = set(uris)
+        rows = self._query_in("SELECT uri, tmdb_id FROM uri_map WHERE uri IN ({})", uris)
+
+        uri_maps = {row["uri"]: row["tmdb_id"] for row in rows}
+        metrics.cache_lookups("query_uri_maps", uris, uri_maps)
+
+        return uri_maps
+
+    # Get the newest addedAt/updatedAt seen in the Plex library index
+    def query_plex_library_state(self, library):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT updated_at FROM plex_library_state WHERE library = ?",
+                (library,),
+            )
+            row = cursor.fetchone()
+            metrics.cache_lookup("query_plex_library_state", row is not None)
+            if row:
+                return row["updated_at"]
+
+        return None
+
+    # Count the items in the Plex library index
+    def count_plex_library(self, library):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM plex_library WHERE library = ?", (library,)
+            )
+            return cursor.fetchone()[0]
+
+    # Store a page of items of the Plex library index
+    def update_plex_library(self, library, items):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                """INSERT OR REPLACE INTO plex_library(library, rating_key, tmdb_id, updated_at)
+                VALUES(?, ?, ?, ?)""",
+                [
+                    (library, rating_key, tmdb_id, item_updated_at)
+                    for rating_key, tmdb_id, item_updated_at in items
+                ],
+            )
+
+    # Remember the newest addedAt/updatedAt stored in the Plex library index
+    def update_plex_library_state(self, library, updated_at):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO plex_library_state(library, updated_at)
+                VALUES(?, ?)""",
+                (library, updated_at),
+            )
+
+    # Empty the Plex library index ahead of a full rebuild
+    def clear_plex_library(self, library):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute("DELETE FROM plex_library WHERE library = ?", (library,))
+            cursor.execute(
+                "DELETE FROM plex_library_state WHERE library = ?", (library,)
+            )
+
+    # Remove rating keys Plex no longer knows from the library index
+    def remove_plex_library_keys(self, library, rating_keys):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "DELETE FROM plex_library WHERE library = ? AND rating_key = ?",
+                [(library, rating_key) for rating_key in rating_keys],
+            )
+
+    # Find Plex ids in the library index by TMDB ids, returns {tmdb_id: plex_id}
+    def query_plex_library(self, library, tmdb_ids):
+        tmdb_ids = set(tmdb_ids)
+        rows = self._query_in(
+            "SELECT tmdb_id, rating_key FROM plex_library WHERE library = ? AND tmdb_id IN ({})",
+            tmdb_ids,
+            (library,),
+        )
+
+        rating_keys = {row["tmdb_id"]: row["rating_key"] for row in rows}
+        metrics.cache_lookups("query_plex_library", tmdb_ids, rating_keys)
+
+        return rating_keys
+
+    # Get the state of the last full sync of a list and collection
+    # Returns letterboxd fingerprint, plex updatedAt, plex child count and sync time
+    def query_sync_state(self, letterboxd_list, library, collection_id):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """SELECT letterboxd_fingerprint, plex_updated_at, plex_child_count, synced_at
+                FROM sync_state WHERE letterboxd_list = ? AND library = ? AND collection_id = ?""",
+                (letterboxd_list, library, collection_id),
+            )
+            row = cursor.fetchone()
+            metrics.cache_lookup("query_sync_state", row is not None)
+            if row:
+                return (
+                    row["letterboxd_fingerprint"],
+                    row["plex_updated_at"],
+                    row["plex_child_count"],
+                    row["synced_at"],
                 )
-                if letterboxd_id is not None:
-                    cursor.execute(
-                        f"UPDATE id_map SET letterboxd_id = ? WHERE tmdb_id = ?",
-                        (letterboxd_id, tmdb_id),
-                    )
-                if plex_id is not None:
-                    cursor.execute(
-                        f"UPDATE id_map SET plex_id = ? WHERE tmdb_id = ?",
-                        (plex_id, tmdb_id),
-                    )
-
-    # Find cached item by TMDB id
-    def query_id_map(self, tmdb_id):
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    f"SELECT tmdb_id, letterboxd_id, plex_id FROM id_map WHERE tmdb_id = ?",
-                    (tmdb_id,),
+
+        return None, None, None, None
+
+    # Store the state of a full sync of a list and collection
+    def update_sync_state(
+        self,
+        letterboxd_list,
+        library,
+        collection_id,
+        letterboxd_fingerprint,
+        plex_updated_at,
+        plex_child_count,
+        synced_at,
+    ):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO sync_state(letterboxd_list, library, collection_id,
+                letterboxd_fingerprint, plex_updated_at, plex_child_count, synced_at)
+                VALUES(?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    letterboxd_list,
+                    library,
+                    collection_id,
+                    letterboxd_fingerprint,
+                    plex_updated_at,
+                    plex_child_count,
+                    synced_at,
+                ),
+            )
+
+    # Get the ordered items (film id, slug), page hashes and time of the last
+    # full crawl of a list snapshot
+    def query_list_snapshot(self, letterboxd_list):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT items, page_hashes, crawled_at FROM list_snapshot WHERE letterboxd_list = ?",
+                (letterboxd_list,),
+            )
+            row = cursor.fetchone()
+            metrics.cache_lookup("query_list_snapshot", row is not None)
+            if row:
+                return (
+                    [tuple(item) for item in json.loads(row["items"])],
+                    json.loads(row["page_hashes"]),
+                    row["crawled_at"],
                 )
-                row = cursor.fetchone()
-                if row:
-                    return row["tmdb_id"], row["letterboxd_id"], row["plex_id"]
 
         return None, None, None
 
-    # Find cached item by Letterboxd id
-    def query_id_map_by_letterboxd(self, letterboxd_id):
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    f"SELECT tmdb_id, letterboxd_id FROM id_map WHERE letterboxd_id = ?",
-                    (letterboxd_id,),
-                )
-                row = cursor.fetchone()
-                if row:
-                    return row["tmdb_id"], row["letterboxd_id"]
+    # Store the ordered items (film id, slug) and page hashes of a list
+    def update_list_snapshot(self, letterboxd_list, items, page_hashes, crawled_at):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO list_snapshot(letterboxd_list, items, page_hashes, crawled_at)
+                VALUES(?, ?, ?, ?)""",
+                (letterboxd_list, json.dumps(items), json.dumps(page_hashes), crawled_at),
+            )
+
+    # Get the TMDB ids of a Radarr library and when they were loaded
+    def query_radarr_library(self, url):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT tmdb_ids, loaded_at FROM radarr_library WHERE url = ?", (url,)
+            )
+            row = cursor.fetchone()
+            metrics.cache_lookup("query_radarr_library", row is not None)
+            if row:
+                return set(json.loads(row["tmdb_ids"])), row["loaded_at"]
 
         return None, None
 
-    # Find cached item by Plex id
-    def query_id_map_by_plex(self, plex_id):
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    f"SELECT tmdb_id, plex_id FROM id_map WHERE plex_id = ?", (plex_id,)
-                )
-                row = cursor.fetchone()
-                if row:
-                    return row["tmdb_id"], row["plex_id"]
+    # Store the TMDB ids of a Radarr library
+    def update_radarr_library(self, url, tmdb_ids, loaded_at):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO radarr_library(url, tmdb_ids, loaded_at)
+                VALUES(?, ?, ?)""",
+                (url, json.dumps(sorted(tmdb_ids)), loaded_at),
+            )
 
-        return None, None
+    # Remember keys that resolved to nothing eg kind "plex:<library>" for TMDB
+    # ids not in a Plex library, kind "letterboxd" for Letterboxd ids without a TMDB id, kind
+    # "letterboxd_uri" for data export uris without one
+    def add_negatives(self, kind, keys):
+        keys = list(keys)
 
-    # Unset Plex id in cache
-    def unset_plex_id(self, tmdb_id):
-        with sqlite3.connect(self.path) as connection:
-            connection.row_factory = sqlite3.Row
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    f"UPDATE id_map SET plex_id = NULL WHERE tmdb_id = ?", (tmdb_id,)
-                )
+        # Nothing to store, and nothing new to evict
+        if not keys:
+            return
+
+        expires_at = int(time.time()) + self.negative_ttl
+
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                """INSERT OR REPLACE INTO negative_cache(kind, key, expires_at)
+                VALUES(?, ?, ?)""",
+                [(kind, key, expires_at) for key in keys],
+            )
+
+        self.evict_negatives()
+
+    # Find keys with an unexpired negative result
+    def query_negatives(self, kind, keys):
+        keys = set(keys)
+        rows = self._query_in(
+            "SELECT key FROM negative_cache WHERE kind = ? AND expires_at > ? AND key IN ({})",
+            keys,
+            (kind, int(time.time())),
+        )
+
+        negatives = {row["key"] for row in rows}
+        # Per library kinds eg plex:<library> are counted together
+        metrics.cache_lookups(f"query_negatives_{kind.split(':', 1)[0]}", keys, negatives)
+
+        return negatives
+
+    # Forget negative results, eg when the item shows up after all
+    def remove_negatives(self, kind, keys):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "DELETE FROM negative_cache WHERE kind = ? AND key = ?",
+                [(kind, key) for key in keys],
+            )
+
+    # Drop expired negative results, then the ones closest to expiry over the limit
+    def evict_negatives(self):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "DELETE FROM negative_cache WHERE expires_at <= ?", (int(time.time()),)
+            )
+            cursor.execute(
+                """DELETE FROM negative_cache WHERE rowid IN (
+                SELECT rowid FROM negative_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)""",
+                (self.negative_max_entries,),
+            )
+
+    # Get the version, list fingerprint and start time of the journal of an
+    # unfinished sync of a list and collection
+    def query_journal(self, letterboxd_list, library, collection_id):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """SELECT version, fingerprint, started_at FROM sync_journal
+                WHERE letterboxd_list = ? AND library = ? AND collection_id = ?""",
+                (letterboxd_list, library, collection_id),
+            )
+            row = cursor.fetchone()
+            metrics.cache_lookup("query_journal", row is not None)
+            if row:
+                return row["version"], row["fingerprint"], row["started_at"]
+
+        return None, None, None
+
+    # Get the entries of a journal as (kind, key, value) eg ("page", 2, "[...]")
+    def query_journal_entries(self, letterboxd_list, library, collection_id):
+        with self.lock, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                """SELECT kind, key, value FROM sync_journal_entry
+                WHERE letterboxd_list = ? AND library = ? AND collection_id = ?""",
+                (letterboxd_list, library, collection_id),
+            )
+            return [(row["kind"], row["key"], row["value"]) for row in cursor.fetchall()]
+
+    # Start an empty journal, replacing any earlier one
+    def start_journal(self, letterboxd_list, library, collection_id, version, fingerprint, started_at):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "DELETE FROM sync_journal_entry WHERE letterboxd_list = ? AND library = ? AND collection_id = ?",
+                (letterboxd_list, library, collection_id),
+            )
+            cursor.execute(
+                """INSERT OR REPLACE INTO sync_journal(letterboxd_list, library, collection_id,
+                version, fingerprint, started_at) VALUES(?, ?, ?, ?, ?, ?)""",
+                (letterboxd_list, library, collection_id, version, fingerprint, started_at),
+            )
+
+    # Add (kind, key, value) entries to a journal in one transaction
+    def add_journal_entries(self, letterboxd_list, library, collection_id, entries):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                """INSERT OR REPLACE INTO sync_journal_entry(letterboxd_list, library,
+                collection_id, kind, key, value) VALUES(?, ?, ?, ?, ?, ?)""",
+                [
+                    (letterboxd_list, library, collection_id, kind, key, value)
+                    for kind, key, value in entries
+                ],
+            )
+
+    # Drop the journal of a finished sync
+    def clear_journal(self, letterboxd_list, library, collection_id):
+        with self.lock, self.connection, closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "DELETE FROM sync_journal_entry WHERE letterboxd_list = ? AND library = ? AND collection_id = ?",
+                (letterboxd_list, library, collection_id),
+            )
+            cursor.execute(
+                "DELETE FROM sync_journal WHERE letterboxd_list = ? AND library = ? AND collection_id = ?",
+                (letterboxd_list, library, collection_id),
+            )
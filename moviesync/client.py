@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from moviesync.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    def __init__(self, config):
+        http_config = config.get("http", {})
+
+        self.timeout = http_config.get("timeout", 30)
+
+        # Requests in flight per host, overridable per host eg "plex:32400": 4
+        self.concurrency = http_config.get("concurrency", 8)
+        self.host_concurrency = http_config.get("hosts", {})
+        self.semaphores = {}
+        # Worker threads per host, as many as its requests in flight. The
+        # default executor is too small to reach them and shared by every host.
+        self.executors = {}
+
+        # Retry connection resets and 5xx responses with exponential backoff.
+        # POST is left out, a retried Radarr add could create duplicates.
+        retry = Retry(
+            total=http_config.get("retries", 3),
+            backoff_factor=http_config.get("backoff", 0.5),
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD", "PUT", "DELETE"]),
+            raise_on_status=False,
+        )
+        pool_size = max(
+            [http_config.get("pool_size", 10), self.concurrency]
+            + list(self.host_concurrency.values())
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Without retries, for callers that retry on their own eg Plex
+        # collection adds, so retries don't multiply
+        single_adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size, max_retries=0
+        )
+
+        self.single_session = requests.Session()
+        self.single_session.mount("https://", single_adapter)
+        self.single_session.mount("http://", single_adapter)
+
+    # Send a request over the pooled session, with the default timeout.
+    # retry=False sends it once, without the connection and 5xx retries.
+    def request(self, method, url, retry=True, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.session if retry else self.single_session
+
+        started = time.perf_counter()
+        status = None
+
+        try:
+            response = session.request(method, url, **kwargs)
+            status = response.status_code
+
+            return response
+        finally:
+            metrics.observe_request(method, url, status, time.perf_counter() - started)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    # Limit requests in flight for the host of the url
+    def _semaphore(self, url):
+        host = urlparse(url).netloc
+
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(
+                self.host_concurrency.get(host, self.concurrency)
+            )
+
+        return self.semaphores[host]
+
+    # Worker threads for the host of the url
+    def _executor(self, url):
+        host = urlparse(url).netloc
+
+        if host not in self.executors:
+            self.executors[host] = ThreadPoolExecutor(
+                max_workers=self.host_concurrency.get(host, self.concurrency),
+                thread_name_prefix=f"http-{host}",
+            )
+
+        return self.executors[host]
+
+    # Run a blocking call for the url on its host's worker threads
+    async def _run(self, url, call, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor(url), functools.partial(call, *args, **kwargs)
+        )
+
+    # Send a request without blocking the event loop
+    async def arequest(self, method, url, **kwargs):
+        async with self._semaphore(url):
+            return await self._run(url, self.request, method, url, **kwargs)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest("GET", url, **kwargs)
+
+    async def aput(self, url, **kwargs):
+        return await self.arequest("PUT", url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest("POST", url, **kwargs)
+
+    async def adelete(self, url, **kwargs):
+        return await self.arequest("DELETE", url, **kwargs)
+
+    # Stream a GET response body into consume, eg an incremental parser,
+    # without holding the whole body in memory. Returns what consume returns.
+    def stream(self, url, consume, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        started = time.perf_counter()
+        status = None
+
+        try:
+            with self.session.get(url, stream=True, **kwargs) as response:
+                status = response.status_code
+
+                response.raise_for_status()
+                response.raw.decode_content = True
+
+                return consume(response.raw)
+        finally:
+            # Includes consuming the body
+            metrics.observe_request("GET", url, status, time.perf_counter() - started)
+
+    async def astream(self, url, consume, **kwargs):
+        async with self._semaphore(url):
+            return await self._run(url, self.stream, url, consume, **kwargs)
+
+    # Close pooled connections and worker threads
+    def close(self):
+        self.session.close()
+        self.single_session.close()
+
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
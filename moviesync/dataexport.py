@@ -0,0 +1,89 @@
+import csv
+import hashlib
+import io
+import zipfile
+from contextlib import contextmanager
+
+# Columns holding the film url, URL in list exports and Letterboxd URI in
+# watchlist, watched and ratings exports
+URI_COLUMNS = ("URL", "Letterboxd URI")
+
+
+# Whether a list source is a local Letterboxd data export, a CSV or a ZIP,
+# the ZIP with an optional member eg letterboxd-export.zip#lists/favourites.csv
+def is_export(source):
+    return source.split("#", 1)[0].lower().endswith((".csv", ".zip"))
+
+
+# Open the CSV of an export as bytes
+@contextmanager
+def _open(source):
+    path, _, member = source.partition("#")
+
+    if not path.lower().endswith(".zip"):
+        with open(path, "rb") as export_file:
+            yield export_file
+
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        if not member:
+            members = [
+                name
+                for name in archive.namelist()
+                if name.startswith("lists/") and name.endswith(".csv")
+            ]
+
+            if len(members) != 1:
+                raise Exception(
+                    f"Export {path} holds {len(members)} lists, pick one eg {path}#lists/<list>.csv"
+                )
+
+            member = members[0]
+
+        with archive.open(member) as export_file:
+            yield export_file
+
+
+# Stream the films of an export in list order as name, year and Letterboxd
+# uri eg https://boxd.it/2bf0. List exports start with a block describing
+# the list, the films follow under their own header.
+def read_films(source):
+    with _open(source) as export_file:
+        reader = csv.reader(
+            io.TextIOWrapper(export_file, encoding="utf-8-sig", newline="")
+        )
+
+        columns = None
+
+        for row in reader:
+            if columns is None:
+                if "Name" in row and "Year" in row:
+                    uri_columns = [column for column in URI_COLUMNS if column in row]
+
+                    if uri_columns:
+                        columns = (
+                            row.index("Name"),
+                            row.index("Year"),
+                            row.index(uri_columns[0]),
+                        )
+                continue
+
+            name, year, uri = (row[i] if i < len(row) else "" for i in columns)
+
+            if uri:
+                yield name, year, uri
+
+        if columns is None:
+            raise Exception(f"No films found in export {source}")
+
+
+# Hash of the CSV of an export, changes whenever the list does
+def fingerprint(source):
+    sha1 = hashlib.sha1()
+
+    with _open(source) as export_file:
+        for chunk in iter(lambda: export_file.read(65536), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
@@ -0,0 +1,136 @@
+import json
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever entries change shape, older journals are discarded
+JOURNAL_VERSION = 2
+
+# Operations recorded per TMDB id. Plex removals and adds aren't, they are
+# planned again from the collection as it is, only Radarr adds can't be.
+OPERATIONS = ("radarr",)
+
+
+# Progress of one sync of a Letterboxd list into a Plex collection of a
+# library eg http://plex:32400/library/sections/1, kept in the cache until
+# the sync finishes. A rerun after a crash resumes from it rather than
+# crawling the list and applying the operations again.
+class Journal:
+    def __init__(self, cache, letterboxd_list, library, collection_id, max_age):
+        self.cache = cache
+        self.letterboxd_list = letterboxd_list
+        self.library = library
+        self.collection_id = collection_id
+        # Don't trust a journal this old, the list may have moved on
+        self.max_age = max_age
+
+        self.pages = {}  # page, (items, page count, has next page)
+        self.operations = defaultdict(set)  # operation, TMDB ids
+
+    # Resume the journal of an unfinished sync if it was of the same list
+    # contents and is recent, otherwise start a new one. Returns whether it
+    # resumed.
+    def open(self, fingerprint):
+        version, last_fingerprint, started_at = self.cache.query_journal(
+            self.letterboxd_list, self.library, self.collection_id
+        )
+
+        reason = None
+
+        if version is None:
+            pass
+        elif version != JOURNAL_VERSION:
+            reason = f"it is version {version}"
+        elif fingerprint is None or fingerprint != last_fingerprint:
+            reason = "the list changed"
+        elif started_at is None or time.time() - started_at > self.max_age:
+            reason = "it is too old"
+        else:
+            try:
+                self._load()
+
+                return True
+            except Exception as err:
+                reason = f"it is corrupt, exception: {err}"
+
+                self.pages = {}
+                self.operations = defaultdict(set)
+
+        if reason is not None:
+            logger.info(
+                f"Discarding sync journal of Letterboxd list ({self.letterboxd_list}), {reason}"
+            )
+
+        self.cache.start_journal(
+            self.letterboxd_list,
+            self.library,
+            self.collection_id,
+            JOURNAL_VERSION,
+            fingerprint,
+            int(time.time()),
+        )
+
+        return False
+
+    def _load(self):
+        for kind, key, value in self.cache.query_journal_entries(
+            self.letterboxd_list, self.library, self.collection_id
+        ):
+            if kind == "page":
+                items, page_count, has_next = json.loads(value)
+                self.pages[int(key)] = (
+                    [(int(film_id), str(film_slug)) for film_id, film_slug in items],
+                    int(page_count),
+                    bool(has_next),
+                )
+            elif kind in OPERATIONS:
+                self.operations[kind].add(int(key))
+            else:
+                raise ValueError(f"Unknown entry {kind}")
+
+    # List pages crawled in order from page 1, as items, page count and
+    # whether there is a next page
+    def crawled_pages(self):
+        pages = []
+
+        while len(pages) + 1 in self.pages:
+            pages.append(self.pages[len(pages) + 1])
+
+        return pages
+
+    # Record a list page once crawled
+    def add_page(self, page, items, page_count, has_next):
+        self.pages[page] = (items, page_count, has_next)
+
+        self.cache.add_journal_entries(
+            self.letterboxd_list,
+            self.library,
+            self.collection_id,
+            [("page", page, json.dumps([items, page_count, has_next]))],
+        )
+
+    # TMDB ids an operation was already applied to
+    def applied(self, operation):
+        return self.operations[operation]
+
+    # Record an operation applied to TMDB ids
+    def record(self, operation, tmdb_ids):
+        tmdb_ids = set(tmdb_ids) - self.operations[operation]
+
+        if not tmdb_ids:
+            return
+
+        self.operations[operation].update(tmdb_ids)
+
+        self.cache.add_journal_entries(
+            self.letterboxd_list,
+            self.library,
+            self.collection_id,
+            [(operation, tmdb_id, None) for tmdb_id in tmdb_ids],
+        )
+
+    # Drop the journal once the sync finished
+    def close(self):
+        self.cache.clear_journal(self.letterboxd_list, self.library, self.collection_id)
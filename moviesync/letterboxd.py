@@ -1,123 +1,670 @@
+import asyncio
+import hashlib
 import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import zendriver as zd
-from bs4 import BeautifulSoup
+import lxml.html
+import requests
+from requests.adapters import HTTPAdapter
+
+from moviesync import dataexport
+from moviesync.browser import BrowserPool
+from moviesync.metrics import metrics
+from moviesync.ratelimit import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Films of a data export looked up in the cache at a time
+EXPORT_BATCH_SIZE = 500
+
+# Resolved films of a list are written to the cache this many at a time, so
+# a crashed sync keeps what it resolved
+RESOLVED_BATCH_SIZE = 100
+
+# Title of a Cloudflare challenge page. Only looked for once a page didn't
+# parse, ordinary pages carry Cloudflare's challenge-platform script too.
+CHALLENGE_TITLE = re.compile(r"<title>\s*Just a moment", re.IGNORECASE)
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+
+BODY_TAG = re.compile(r"<body\b([^>]*)>", re.IGNORECASE)
+TMDB_ID_ATTRIBUTE = re.compile(r"""\bdata-tmdb-id\s*=\s*["']?([^"'\s>]*)""")
+
+
+# A challenge, or a page without what we're after
+class UnexpectedPage(Exception):
+    pass
+
+
+# A bot challenge or a 429, the rate limiter backs off
+class Challenged(UnexpectedPage):
+    pass
+
+
+# Parse a page with parse, one it can't make sense of is a challenge if it
+# has the challenge title
+def _parse_page(parse, html):
+    try:
+        return parse(html)
+    except UnexpectedPage as err:
+        if CHALLENGE_TITLE.search(html):
+            raise Challenged("Challenged") from err
+
+        raise
+
+
+# XPath test for a class name eg .poster-grid
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Parse a list page, without building a full soup. Returns the id and slug
+# of each item eg 448506, despicable-me-4, the number of pages from the
+# paginator and whether there is a next page.
+def _parse_list_page(html):
+    root = lxml.html.fromstring(html)
+
+    if not root.xpath(f"//*[{_has_class('poster-grid')}]"):
+        raise UnexpectedPage("No poster grid")
+
+    # Restrict to main column, avoid 'cloned from'
+    section = root.xpath(f"//section[{_has_class('col-main')}]")
+
+    if not section:
+        raise UnexpectedPage("No main column")
+
+    items = [
+        (int(div.get("data-film-id")), div.get("data-item-slug"))
+        for div in section[0].iterfind(".//div[@data-film-id]")
+    ]
+
+    pages = [
+        int(text)
+        for text in (
+            element.text_content().strip()
+            for element in root.xpath(
+                f"//*[{_has_class('paginate-pages')}]//*[self::a or self::span]"
+            )
+        )
+        if text.isdigit()
+    ]
+
+    has_next = bool(root.xpath(f"//a[{_has_class('next')}]"))
+
+    return items, max(pages, default=1), has_next
+
+
+# Parse the TMDB id of a film page, None if it has none. Only reads the body
+# tag, the rest of the page is never parsed.
+def _parse_film_page(html):
+    body = BODY_TAG.search(html)
+    tmdb_id = TMDB_ID_ATTRIBUTE.search(body.group(1)) if body else None
+
+    if tmdb_id is None:
+        raise UnexpectedPage("No TMDB id attribute")
+
+    return int(tmdb_id.group(1)) if tmdb_id.group(1) else None
+
 
 class Letterboxd:
-    base_url = "https://letterboxd.com"
+    def __init__(self, config, cache):
+        letterboxd_config = config.get("letterboxd", {})
 
-    def __init__(self, cache):
+        self.base_url = letterboxd_config.get("base_url", "https://letterboxd.com")
         self.cache = cache
+        self.browser = BrowserPool(
+            letterboxd_config.get("tabs", 4), letterboxd_config.get("headless", False)
+        )
+
+        connections = letterboxd_config.get("connections", 8)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        # Fetches and parses run here rather than on the default executor,
+        # which is too small for connections and shared with other hosts
+        self.executor = ThreadPoolExecutor(
+            max_workers=connections, thread_name_prefix="letterboxd"
+        )
+
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": USER_AGENT})
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = letterboxd_config.get("timeout", 30)
+        # Crawl every page again once a list snapshot is this old
+        self.snapshot_max_age = letterboxd_config.get("snapshot_max_age", 86400)
+        # Shared by HTTP and browser fetches, starts at rate requests a second
+        # and finds the fastest rate Letterboxd allows up to max_rate
+        self.limiter = RateLimiter(
+            "Letterboxd",
+            letterboxd_config.get("rate", 10),
+            letterboxd_config.get("max_rate", 50),
+            letterboxd_config.get("min_rate", 0.5),
+            connections,
+        )
+
+        self.http_fetches = 0
+        self.browser_fetches = 0
+
+    # Stop the shared browser session and HTTP connections
+    async def close(self):
+        await self.browser.stop()
+        self.session.close()
+        self.executor.shutdown(wait=False)
+
+    # Plain HTTP fetch, raises Challenged on a challenge status or header
+    def _http_get(self, url, endpoint):
+        started = time.perf_counter()
+        status = None
+
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            status = response.status_code
+        finally:
+            metrics.observe_request(
+                "GET", url, status, time.perf_counter() - started, endpoint
+            )
+
+        if response.status_code in (403, 429, 503):
+            raise Challenged(f"Challenged, status {response.status_code}")
+
+        if response.headers.get("cf-mitigated") == "challenge":
+            raise Challenged("Challenged, cf-mitigated header")
+
+        response.raise_for_status()
+
+        return response.text
+
+    # Fetch and parse a page over HTTP, in a worker thread
+    def _http_fetch(self, url, endpoint, parse):
+        return _parse_page(parse, self._http_get(url, endpoint))
+
+    # Fetch a page over HTTP, fall back to the browser if challenged, if parse
+    # finds the page isn't what was expected or if the connection failed.
+    # Other HTTP errors eg a 404 are raised, the browser wouldn't do better
+    # and would time out waiting for wait_element. Requests are counted per
+    # endpoint, eg /film/{slug}/ rather than per film. Parsing runs off the
+    # event loop, so it doesn't hold up other fetches.
+    async def _fetch(self, url, endpoint, parse, wait_element):
+        try:
+            async with self.limiter.slot() as slot:
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self._http_fetch, url, endpoint, parse
+                    )
+                except (Challenged, requests.Timeout):
+                    slot.throttled()
+                    raise
+
+            self.http_fetches += 1
+
+            return result
+        except (UnexpectedPage, requests.ConnectionError, requests.Timeout) as err:
+            logger.debug(f"Unable to fetch {url} over HTTP, exception: {err}")
+
+        logger.debug(f"Falling back to browser for {url}")
+        self.browser_fetches += 1
+
+        return await self._parse_url(url, wait_element, parse)
+
+    # Url of a page of a list url
+    def _page_url(self, list_url, page):
+        if not list_url.endswith("/"):
+            list_url = f"{list_url}/"
+
+        return list_url if page == 1 else f"{list_url}page/{page}/"
+
+    # Fetch a page of a list url, returns its items, the number of pages and
+    # whether there is a next page
+    async def _get_list_page(self, list_url, page):
+        logger.debug(f"Get page {page} of {list_url}")
+
+        page_items, page_count, has_next = await self._fetch(
+            self._page_url(list_url, page),
+            "/{list}/page/{n}/",
+            _parse_list_page,
+            ".poster-grid",
+        )
+
+        logger.debug(f"Found {len(page_items)} item(s) on page {page} of {list_url}")
+
+        return page_items, page_count, has_next
+
+    # Hash of the ordered film ids of a list page
+    def _page_hash(self, page_items):
+        film_ids = ",".join(str(film_id) for film_id, film_slug in page_items)
+
+        return hashlib.sha1(film_ids.encode()).hexdigest()
+
+    # Offset of a page as a contiguous run in the snapshot, None if it isn't one
+    def _align_page(self, snapshot_items, positions, page_items):
+        if not page_items or page_items[0][0] not in positions:
+            return None
+
+        offset = positions[page_items[0][0]]
+        snapshot_page = snapshot_items[offset : offset + len(page_items)]
+
+        if [item[0] for item in snapshot_page] != [item[0] for item in page_items]:
+            return None
+
+        return offset
 
     # Parse list url eg /jdemeza/watchlist/by/release/
     # Parse id and slug of each item eg 448506, despicable-me-4
-    async def _parse_items(self, list_url):
+    # Stops early when the rest of the list is unchanged since the last snapshot
+    # With a queue, new items are put on it as each page is parsed and None
+    # once the list is done, so they can be resolved while pages load
+    # With a journal, pages crawled by an unfinished sync aren't fetched again
+    # With a first page, eg fetched for the fingerprint, page 1 isn't either
+    # With force, every page is crawled without reusing the snapshot, the only
+    # way besides an expired snapshot to see changes in the middle of the list
+    async def _parse_items(
+        self, list_url, queue=None, journal=None, first_page=None, force=False
+    ):
+        try:
+            return await self._crawl_items(list_url, queue, journal, first_page, force)
+        finally:
+            if queue is not None:
+                queue.put_nowait(None)
+
+    async def _crawl_items(self, list_url, queue, journal, first_page, force):
         items = []
+        page_hashes = []
+
+        def emit(new_items):
+            if queue is not None and new_items:
+                queue.put_nowait(new_items)
 
         logger.debug(f"Parse url {list_url}")
 
-        browser = await zd.start(headless=False, no_sandbox=True)
+        snapshot_items, snapshot_hashes, crawled_at = self.cache.query_list_snapshot(
+            list_url
+        )
+
+        if crawled_at is not None and time.time() - crawled_at > self.snapshot_max_age:
+            logger.debug(f"Snapshot of {list_url} is too old, crawling every page")
+            snapshot_items = None
+        elif force and snapshot_items is not None:
+            logger.debug(f"Forced sync of {list_url}, crawling every page")
+            snapshot_items = None
+
+        positions = {item[0]: i for i, item in enumerate(snapshot_items or [])}
+
+        page_count = 1
+        page_size = 0
+        last_page = None  # fetched at most once, to verify a reused tail
+        reused = False
+        crawled = False
 
         i = 1
 
-        page = await browser.get(list_url)
+        for page_items, list_page_count, has_next in (
+            journal.crawled_pages() if journal is not None else []
+        ):
+            items.extend(page_items)
+            page_hashes.append(self._page_hash(page_items))
+            emit(page_items)
 
-        while True:
-            logger.debug(f"Get page {i} of {list_url}")
+            if i == 1:
+                page_count = list_page_count
+                page_size = len(page_items)
 
-            # Wait for page to load
-            await page.select(".poster-grid")
+            if not has_next:
+                crawled = True
+                break
 
-            response = await page.get_content()
+            i += 1
 
-            soup = BeautifulSoup(response, "lxml")
+        if crawled:
+            logger.info(f"All {i} page(s) of {list_url} already crawled, resuming")
+        elif i > 1:
+            logger.info(f"Resuming {list_url} from page {i} of {page_count}")
 
-            # Restrict to main column, avoid 'cloned from'
-            section = soup.find("section", {"class": "col-main"})
+        while not crawled:
+            if i == page_count and last_page is not None:
+                # Already fetched while checking the snapshot
+                items.extend(last_page)
+                emit(last_page)
+                page_hashes.append(self._page_hash(last_page))
+                break
 
-            divs = section.find_all("div", {"data-film-id": True})
+            if i == 1 and first_page is not None:
+                page_items, list_page_count, has_next = first_page
+            else:
+                page_items, list_page_count, has_next = await self._get_list_page(
+                    list_url, i
+                )
 
-            for div in divs:
-                film_id = int(div["data-film-id"])
-                film_slug = div["data-item-slug"]
-                logger.debug(f"Found slug {film_slug} for id {film_id}")
-                items.append((film_id, film_slug))
+            page_hash = self._page_hash(page_items)
 
-            next_button = await page.query_selector("a.next")
+            items.extend(page_items)
+            page_hashes.append(page_hash)
+            emit(page_items)
 
-            if next_button:
-                i += 1
+            if journal is not None:
+                journal.add_page(i, page_items, list_page_count, has_next)
 
-                await next_button.click()
-            else:
+            if not has_next:
                 break
 
-        await browser.stop()
+            if i == 1:
+                page_count = list_page_count
+                page_size = len(page_items)
+
+            if snapshot_items:
+                # Same page unchanged in place, or shifted by adds/removes above it
+                if snapshot_hashes[i - 1 : i] == [page_hash]:
+                    offset = (i - 1) * page_size
+                else:
+                    offset = self._align_page(snapshot_items, positions, page_items)
+
+                if offset is not None:
+                    predicted = items + snapshot_items[offset + len(page_items) :]
+                    last_start = (page_count - 1) * page_size
+
+                    # The predicted list must fill exactly page_count pages and
+                    # end with the actual last page
+                    if last_start < len(predicted) <= page_count * page_size:
+                        if last_page is None:
+                            last_page, _, _ = await self._get_list_page(
+                                list_url, page_count
+                            )
+
+                        if [item[0] for item in last_page] == [
+                            item[0] for item in predicted[last_start:]
+                        ]:
+                            logger.debug(
+                                f"Pages {i + 1} to {page_count} of {list_url} unchanged, reusing snapshot"
+                            )
+
+                            emit(predicted[len(items) :])
+
+                            items = predicted
+                            reused = True
+                            page_hashes = [
+                                self._page_hash(items[j : j + page_size])
+                                for j in range(0, len(items), page_size)
+                            ]
+                            break
+
+            i += 1
+
+        # A reused tail doesn't count as a full crawl
+        self.cache.update_list_snapshot(
+            list_url, items, page_hashes, crawled_at if reused else int(time.time())
+        )
 
         return items
 
-    async def _parse_url(self, url, wait_element):
+    # Fingerprint a Letterboxd list from its first page only, the ordered
+    # film ids of that page and the number of pages. A data export is
+    # fingerprinted from its content. Returns the fingerprint and the parsed
+    # first page, for get_tmdb_ids to reuse (None for a data export).
+    async def get_fingerprint(self, list_url):
+        if dataexport.is_export(list_url):
+            return await asyncio.to_thread(dataexport.fingerprint, list_url), None
+
+        first_page = await self._get_list_page(f"{self.base_url}{list_url}", 1)
+        page_items, page_count, has_next = first_page
+
+        fingerprint = hashlib.sha1(
+            f"{self._page_hash(page_items)}|{page_count}".encode()
+        ).hexdigest()
+
+        return fingerprint, first_page
+
+    # Load a url in the browser, paced with the HTTP fetches, and parse it
+    # with parse off the event loop
+    async def _parse_url(self, url, wait_element, parse):
         logger.debug(f"Parse url {url}")
 
-        browser = await zd.start(headless=False, no_sandbox=True)
+        async with self.limiter.slot() as slot:
+            try:
+                response, timed_out = await self.browser.get_content(url, wait_element)
+            except asyncio.TimeoutError:
+                slot.throttled()
+                raise
+
+            # The page is still parsed, it may have loaded enough
+            if timed_out:
+                slot.throttled()
+
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, _parse_page, parse, response
+                )
+            except Challenged:
+                slot.throttled()
+                raise
+
+    # Resolve the TMDB id of a film from its Letterboxd page, None if it has none
+    async def _parse_tmdb_id(self, film_id, film_slug):
+        return await self._get_film_tmdb_id(
+            f"{self.base_url}/film/{film_slug}",
+            "/film/{slug}/",
+            f"Letterboxd id {film_id}",
+        )
+
+    # Resolve the TMDB id of a film from its uri in a data export, the short
+    # boxd.it ones redirect to the film page
+    async def _parse_uri_tmdb_id(self, uri):
+        return await self._get_film_tmdb_id(uri, "/{uri}", f"Letterboxd uri {uri}")
+
+    async def _get_film_tmdb_id(self, url, endpoint, film):
+        try:
+            tmdb_id = await self._fetch(url, endpoint, _parse_film_page, "body.film")
+        except Challenged:
+            # Not an answer, don't remember the film as having no TMDB id
+            raise
+        except UnexpectedPage:
+            # Rendered by the browser, without the attribute at all
+            tmdb_id = None
+
+        if tmdb_id is None:
+            logger.debug(f"Could not find tmdb id for {film}")
+            return None
+
+        logger.debug(f"Found tmdb id {tmdb_id} for {film}")
+
+        return tmdb_id
+
+    # Log how many fetches needed the browser, and the pace they settled at
+    def _log_fetch_stats(self):
+        total = self.http_fetches + self.browser_fetches
+
+        if total:
+            logger.info(
+                f"Letterboxd fetches: {total}, browser fallbacks: {self.browser_fetches} ({self.browser_fetches / total:.0%})"
+            )
+            logger.info(self.limiter.describe())
+
+    # Resolve a batch of data export uris into tmdb_ids, in order
+    async def _add_export_films(self, tmdb_ids, uris):
+        # Check cache first
+        resolved = self.cache.query_uri_maps(uris)
+        # Skip films recently found to have no TMDB id
+        no_tmdb_id = self.cache.query_negatives(
+            "letterboxd_uri", [uri for uri in uris if uri not in resolved]
+        )
+        missing = list(
+            dict.fromkeys(
+                uri for uri in uris if uri not in resolved and uri not in no_tmdb_id
+            )
+        )
+
+        logger.debug(
+            f"Found {len(uris) - len(missing)} of {len(uris)} Letterboxd uris in cache, {len(no_tmdb_id)} without TMDB id"
+        )
+
+        results = await asyncio.gather(
+            *[self._parse_uri_tmdb_id(uri) for uri in missing],
+            return_exceptions=True,
+        )
+
+        new_uri_maps = []
+        new_negatives = []
+
+        for uri, tmdb_id in zip(missing, results):
+            if isinstance(tmdb_id, Exception):
+                logger.error(
+                    f"Unable to load Letterboxd film {uri}, exception: {tmdb_id}"
+                )
+            elif tmdb_id is None:
+                new_negatives.append(uri)
+            else:
+                resolved[uri] = tmdb_id
+                new_uri_maps.append((uri, tmdb_id))
+
+        self.cache.add_uri_maps(new_uri_maps)
+        self.cache.add_negatives("letterboxd_uri", new_negatives)
 
-        page = await browser.get(url)
+        for uri in uris:
+            tmdb_id = resolved.get(uri)
+
+            if tmdb_id is not None:
+                tmdb_ids[tmdb_id] = uri
+
+    # Get TMDB ids from a local data export, streamed in batches so only the
+    # films missing from the cache are looked up on Letterboxd
+    async def _get_export_tmdb_ids(self, source):
+        tmdb_ids = {}
 
         try:
-            await page.select(wait_element)
+            uris = []
+
+            for name, year, uri in dataexport.read_films(source):
+                uris.append(uri)
+
+                if len(uris) >= EXPORT_BATCH_SIZE:
+                    await self._add_export_films(tmdb_ids, uris)
+                    uris = []
+
+            await self._add_export_films(tmdb_ids, uris)
         except Exception as err:
-            logger.error(f"Error waiting for page to load: {err}")
+            logger.error(f"Unable to read Letterboxd data export, exception: {err}")
+            tmdb_ids = None
 
-        response = await page.get_content()
+        self._log_fetch_stats()
 
-        await browser.stop()
+        return tmdb_ids
 
-        return response
+    # Get TMDB ids from a Letterboxd list, or from a local data export.
+    # first_page is the one returned by get_fingerprint, if any. With force
+    # the list snapshot isn't reused.
+    async def get_tmdb_ids(self, list_url, journal=None, first_page=None, force=False):
+        if dataexport.is_export(list_url):
+            return await self._get_export_tmdb_ids(list_url)
 
-    # Get TMDB ids from a Letterboxd list
-    async def get_tmdb_ids(self, list_url):
         tmdb_ids = {}
 
-        try:
-            items = await self._parse_items(f"{self.base_url}{list_url}")
+        # List pages feed a queue, cache lookups and film page resolution
+        # consume it while the next pages load
+        queue = asyncio.Queue()
+        producer = asyncio.create_task(
+            self._parse_items(
+                f"{self.base_url}{list_url}", queue, journal, first_page, force
+            )
+        )
+
+        items = []
+        resolved = {}  # film_id, tmdb_id
+        lookups = {}  # film_id, task resolving its TMDB id
+        negatives = 0
+
+        # Resolved films not yet written to the cache
+        new_id_maps = []
+        new_negatives = []
+        added = [0, 0]  # id maps, negatives
+
+        def save_resolved():
+            if not new_id_maps and not new_negatives:
+                return
+
+            self.cache.add_id_maps(new_id_maps)
+            self.cache.add_negatives("letterboxd", new_negatives)
+
+            added[0] += len(new_id_maps)
+            added[1] += len(new_negatives)
+            new_id_maps.clear()
+            new_negatives.clear()
+
+        async def resolve(film_id, film_slug):
+            try:
+                tmdb_id = await self._parse_tmdb_id(film_id, film_slug)
+            except Exception as err:
+                logger.error(
+                    f"Unable to load Letterboxd film {film_slug}, exception: {err}"
+                )
+                return
+
+            if tmdb_id is None:
+                new_negatives.append(film_id)
+            else:
+                resolved[film_id] = tmdb_id
+                new_id_maps.append((tmdb_id, film_id))
+
+            if len(new_id_maps) + len(new_negatives) >= RESOLVED_BATCH_SIZE:
+                save_resolved()
 
-            for item in items:
-                film_id, film_slug = item
+        try:
+            while (page_items := await queue.get()) is not None:
+                items.extend(page_items)
+                film_ids = [film_id for film_id, film_slug in page_items]
 
                 # Check cache first
-                tmdb_id, letterboxd_id = self.cache.query_id_map_by_letterboxd(film_id)
+                resolved.update(self.cache.query_id_maps_by_letterboxd(film_ids))
+                # Skip films recently found to have no TMDB id
+                no_tmdb_id = self.cache.query_negatives(
+                    "letterboxd",
+                    [film_id for film_id in film_ids if film_id not in resolved],
+                )
+                negatives += len(no_tmdb_id)
+
+                # Resolve cache misses concurrently, bounded by the connection
+                # and tab pools
+                for film_id, film_slug in page_items:
+                    if (
+                        film_id not in resolved
+                        and film_id not in no_tmdb_id
+                        and film_id not in lookups
+                    ):
+                        lookups[film_id] = asyncio.create_task(
+                            resolve(film_id, film_slug)
+                        )
 
-                if tmdb_id is None:
-                    response = await self._parse_url(
-                        f"{self.base_url}/film/{film_slug}", "body.film"
-                    )
-                    soup = BeautifulSoup(response, "lxml")
-                    body = soup.find("body")
+            # Raises if the crawl failed
+            await producer
 
-                    str_tmdb_id = body.get("data-tmdb-id")
+            logger.debug(
+                f"Found {len(items) - len(lookups)} of {len(items)} Letterboxd ids in cache, {negatives} without TMDB id"
+            )
 
-                    if not str_tmdb_id:
-                        logger.debug(
-                            f"Could not find tmdb id for Letterboxd id {film_id}"
-                        )
-                        continue
+            await asyncio.gather(*lookups.values())
 
-                    tmdb_id = int(str_tmdb_id)
-                    self.cache.add_id_map(tmdb_id, film_id, None)
-                    logger.debug(
-                        f"Found tmdb id {tmdb_id} for Letterboxd id {film_id}, added to cache"
-                    )
-                else:
-                    logger.debug(
-                        f"Found tmdb id {tmdb_id} for Letterboxd id {film_id} in cache"
-                    )
+            save_resolved()
+            logger.debug(
+                f"Added {added[0]} Letterboxd ids to cache, {added[1]} without TMDB id"
+            )
+
+            # Keep the list order
+            for film_id, film_slug in items:
+                tmdb_id = resolved.get(film_id)
 
-                tmdb_ids[tmdb_id] = film_id
+                if tmdb_id is not None:
+                    tmdb_ids[tmdb_id] = film_id
         except Exception as err:
             logger.error(f"Unable to parse Letterboxd list, exception: {err}")
             tmdb_ids = None
+        finally:
+            # Only left running when the list failed
+            producer.cancel()
+
+            for lookup in lookups.values():
+                lookup.cancel()
+
+            # Keep what was resolved before a failure
+            save_resolved()
+
+        self._log_fetch_stats()
 
         return tmdb_ids
@@ -1,117 +1,412 @@
+import asyncio
 import logging
+import time
+
+from moviesync import utils
+from moviesync.journal import Journal
+from moviesync.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
 class LetterboxdExport:
-    def __init__(self, letterboxd, plex, radarr):
+    def __init__(self, letterboxd, plexes, radarr, cache, config):
         self.letterboxd = letterboxd
-        self.plex = plex
+        # Plex by target name, see plex.plex_targets
+        self.plexes = plexes
         self.radarr = radarr
+        self.cache = cache
+        # Run a full sync at least this often even when nothing changed
+        self.full_sync_interval = config.get("sync", {}).get(
+            "full_sync_interval", 86400
+        )
+        # Resume an unfinished sync only if it started this recently
+        self.journal_max_age = config.get("sync", {}).get("journal_max_age", 3600)
+        # Targets add to the one Radarr in turn, so a movie missing from
+        # several of them is added once
+        self.radarr_lock = asyncio.Lock()
 
-    # Add items to Plex
-    def _add_to_plex(self, letterboxd_ids, plex_collection_id, plex_ids):
-        not_plex = set(letterboxd_ids.keys()).difference(plex_ids.keys())
+    # Add items to Plex, returns the TMDB ids not in Plex and whether every
+    # item was either added or found not to be in Plex
+    async def _add_to_plex(self, plex, letterboxd_ids, plex_collection_id, plex_ids):
+        # In list order, sequential chunks then land already sorted
+        not_plex = [tmdb_id for tmdb_id in letterboxd_ids if tmdb_id not in plex_ids]
         # added = {}        # tmdb_id, plex_id, fromcache
         # not_found = []    # tmdb_id
-        added, not_found = self.plex.add_items(plex_collection_id, not_plex)
+        added, not_found, chunks = await plex.add_items(plex_collection_id, not_plex)
+
+        if chunks:
+            logger.info(
+                f"Added {sum(chunk['added'] for chunk in chunks)} of {sum(chunk['items'] for chunk in chunks)} item(s) "
+                f"to Plex ({plex.target}) in {len(chunks)} chunk(s), {sum(chunk['seconds'] for chunk in chunks):.2f}s"
+            )
+
         if added:
             plex_ids.update(added)
 
-        return not_found
+        # Failed chunks and lookups leave items neither added nor not found
+        complete = set(not_plex).issubset((added or {}).keys() | set(not_found or []))
 
-    # Add items to Radarr
-    def _add_to_radarr(self, letterboxd_ids, not_found):
+        return not_found, complete
+
+    # Add items to Radarr, skipping the ones an unfinished sync already added
+    async def _add_to_radarr(self, letterboxd_ids, not_found, journal):
         if not_found:
-            for radarr_tmdb in not_found:
-                radarr_movie = self.radarr.get_movie(radarr_tmdb)
+            async with self.radarr_lock:
+                library = await self.radarr.get_library()
+
+                if library is not None:
+                    missing = [
+                        radarr_tmdb
+                        for radarr_tmdb in not_found
+                        if radarr_tmdb not in library
+                        and radarr_tmdb not in journal.applied("radarr")
+                    ]
+
+                    logger.debug(
+                        f"{len(not_found) - len(missing)} of {len(not_found)} movie(s) already in Radarr"
+                    )
 
-                if radarr_movie is not None and not radarr_movie:
-                    logger.debug(f"Can't find movie {radarr_tmdb} in Radarr")
+                    if missing:
+                        added = await self.radarr.add_movies(missing)
+                        journal.record(
+                            "radarr",
+                            [
+                                radarr_tmdb
+                                for radarr_tmdb, success in added.items()
+                                if success
+                            ],
+                        )
 
-                    if self.radarr.add_movie(radarr_tmdb):
-                        logger.debug(f"Added movie {radarr_tmdb} to Radarr")
+                        for radarr_tmdb, success in added.items():
+                            if success:
+                                logger.debug(f"Added movie {radarr_tmdb} to Radarr")
+                            else:
+                                logger.debug(
+                                    f"Unable to add movie {radarr_tmdb} to Radarr"
+                                )
 
+                        logger.info(
+                            f"Added {list(added.values()).count(True)} of {len(missing)} movie(s) to Radarr"
+                        )
+
+            for radarr_tmdb in not_found:
                 # Not in Plex after add, so need to be excluded from Letterboxd sort
                 del letterboxd_ids[radarr_tmdb]
 
+    # Refresh the Plex library index ahead of the adds, add_items tries
+    # again if this fails
+    async def _refresh_plex_index(self, plex):
+        try:
+            await plex.refresh_library_index()
+        except Exception as err:
+            logger.error(
+                f"Unable to refresh Plex library index ({plex.target}), exception: {err}"
+            )
+
     # Get Plex collection based on title
-    def _get_plex_collection_id(self, plex_collection_title):
-        logger.debug(f"Get Plex collection based on title: {plex_collection_title}")
+    async def _get_plex_collection_id(self, plex, plex_collection_title):
+        logger.debug(
+            f"Get Plex collection based on title: {plex_collection_title} ({plex.target})"
+        )
 
-        plex_collections = self.plex.get_collection_ids(plex_collection_title)
+        plex_collections = await plex.get_collection_ids(plex_collection_title)
 
         if plex_collections:
             return plex_collections[0]
 
         return 0
 
-    # Remove items from Plex
-    def _remove_from_plex(self, letterboxd_ids, collection_id, plex_ids):
-        not_letterboxd = set(plex_ids.keys()).difference(letterboxd_ids.keys())
-        for key in not_letterboxd:
-            if self.plex.remove_item(collection_id, plex_ids[key]):
+    # Remove items from Plex, returns whether every removal succeeded
+    async def _remove_from_plex(self, plex, letterboxd_ids, collection_id, plex_ids):
+        not_letterboxd = list(set(plex_ids.keys()).difference(letterboxd_ids.keys()))
+        removed = await asyncio.gather(
+            *[plex.remove_item(collection_id, plex_ids[key]) for key in not_letterboxd]
+        )
+        for key, success in zip(not_letterboxd, removed):
+            if success:
                 del plex_ids[key]
 
-    # Sort Plex items
-    def _sort_plex_list(self, letterboxd_ids, collection_id, plex_ids):
-        plex_id_keys = list(plex_ids.keys())
-        previous = None
+        return all(removed)
+
+    # Sort Plex items, returns whether every move succeeded
+    async def _sort_plex_list(self, plex, letterboxd_ids, collection_id, plex_ids):
+        moves = utils.plan_moves(list(plex_ids.keys()), list(letterboxd_ids.keys()))
+
+        logger.debug(f"Planned {len(moves)} move(s) for {len(plex_ids)} item(s)")
 
-        for i, item in enumerate(letterboxd_ids, 0):
-            if item != plex_id_keys[i]:
-                # Out of order, determine current place in the list
-                idx = plex_id_keys.index(item)
-                actual = plex_ids[plex_id_keys[idx]]
+        moved = 0
 
-                if self.plex.move_item(collection_id, actual, previous):
-                    logger.debug(f"Moved {actual} after {previous}")
+        # Each move is relative to the previous one, so keep them in order
+        for item, after in moves:
+            actual = plex_ids[item]
+            previous = plex_ids[after] if after is not None else None
 
-                    plex_id_keys.insert(i, plex_id_keys.pop(idx))
+            if await plex.move_item(collection_id, actual, previous):
+                logger.debug(f"Moved {actual} after {previous}")
 
-            # Update current position
-            previous = plex_ids[plex_id_keys[i]]
+                moved += 1
 
-    # Sync with Plex and Radarr
-    async def to_plex(self, letterboxd_list, plex_collection_title):
         logger.info(
-            f"Starting sync between Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_title})."
+            f"Executed {moved} of {len(moves)} planned move(s) in Plex ({plex.target})"
         )
 
-        plex_collection_id = self._get_plex_collection_id(plex_collection_title)
+        return moved == len(moves)
 
-        if plex_collection_id == 0:
-            raise Exception("Unable to retrieve Plex collection.")
+    # Check whether the list and collection are unchanged since the last sync
+    def _is_unchanged(
+        self, letterboxd_list, plex, collection_id, fingerprint, plex_state
+    ):
+        (
+            last_fingerprint,
+            last_updated_at,
+            last_child_count,
+            synced_at,
+        ) = self.cache.query_sync_state(letterboxd_list, plex.library, collection_id)
 
-        # Get TMDB ids from the Letterboxd list
-        logger.debug(f"Parsing Letterboxd list: {letterboxd_list}")
-        letterboxd_ids = await self.letterboxd.get_tmdb_ids(letterboxd_list)
+        if fingerprint is None or plex_state[0] is None or synced_at is None:
+            return False
 
-        if letterboxd_ids is None:
-            raise Exception("Unable to retrieve Letterboxd list items.")
+        if time.time() - synced_at > self.full_sync_interval:
+            logger.debug(f"Last full sync of Plex ({plex.target}) is too old, syncing.")
+            return False
+
+        return (fingerprint, *plex_state) == (
+            last_fingerprint,
+            last_updated_at,
+            last_child_count,
+        )
+
+    # Remember the list fingerprint and collection state after a sync
+    async def _save_sync_state(self, letterboxd_list, plex, collection_id, fingerprint):
+        # Our own changes update the collection, so read its state again
+        updated_at, child_count = await plex.get_collection_state(collection_id)
+
+        if fingerprint is None or updated_at is None:
+            return
+
+        self.cache.update_sync_state(
+            letterboxd_list,
+            plex.library,
+            collection_id,
+            fingerprint,
+            updated_at,
+            child_count,
+            int(time.time()),
+        )
 
-        # Get TMDB ids from the Plex collection
-        logger.debug(f"Parsing Plex collection: {plex_collection_title}")
-        plex_ids = self.plex.get_tmdb_ids(plex_collection_id)
+    # Sync the resolved list into the collection of one Plex target
+    async def _sync_target(
+        self,
+        letterboxd_list,
+        fingerprint,
+        letterboxd_ids,
+        plex,
+        plex_collection_id,
+        plex_ids,
+        journal,
+    ):
         if plex_ids is None:
             raise Exception("Unable to retrieve Plex collection items.")
 
         # Items that are in Plex but not Letterboxd, remove from Plex.
-        logger.debug("Removing items from Plex collection that aren't in Letterboxd.")
-        self._remove_from_plex(letterboxd_ids, plex_collection_id, plex_ids)
+        logger.debug(
+            f"Removing items from Plex collection ({plex.target}) that aren't in Letterboxd."
+        )
+        with metrics.stage("plex_remove"):
+            removed = await self._remove_from_plex(
+                plex, letterboxd_ids, plex_collection_id, plex_ids
+            )
 
         # Items that are in Letterboxd but not Plex, add to Plex.
-        logger.debug("Adding items from Letterboxd that aren't in Plex collection.")
-        not_found = self._add_to_plex(letterboxd_ids, plex_collection_id, plex_ids)
+        logger.debug(
+            f"Adding items from Letterboxd that aren't in Plex collection ({plex.target})."
+        )
+        with metrics.stage("plex_add"):
+            not_found, added = await self._add_to_plex(
+                plex, letterboxd_ids, plex_collection_id, plex_ids
+            )
 
         # If the item is also not in the Plex collection, add the item to Radarr.
-        logger.debug("Adding items to Radarr that aren't in Plex collection.")
-        self._add_to_radarr(letterboxd_ids, not_found)
+        logger.debug(
+            f"Adding items to Radarr that aren't in Plex collection ({plex.target})."
+        )
+        with metrics.stage("radarr"):
+            await self._add_to_radarr(letterboxd_ids, not_found, journal)
 
         # Letterboxd list and Plex collection should now be the same length for sorting
-        logger.debug("Sorting Plex collection.")
-        self._sort_plex_list(letterboxd_ids, plex_collection_id, plex_ids)
+        logger.debug(f"Sorting Plex collection ({plex.target}).")
+        with metrics.stage("plex_sort"):
+            moved = await self._sort_plex_list(
+                plex, letterboxd_ids, plex_collection_id, plex_ids
+            )
+
+        # Saved state would skip the next runs until the next full sync, keep
+        # the journal too so the next run resumes. Radarr adds are left out,
+        # a movie Radarr can't add would never let the state be saved.
+        if not (removed and added and moved):
+            logger.info(
+                f"Sync of Plex collection ({plex.target}) incomplete, syncing again on the next run"
+            )
+            return
+
+        with metrics.stage("save_state"):
+            await self._save_sync_state(
+                letterboxd_list, plex, plex_collection_id, fingerprint
+            )
+
+            journal.close()
+
+    # Sync with Plex and Radarr, on every Plex target unless targets names
+    # some of them
+    async def to_plex(
+        self, letterboxd_list, plex_collection_title, force=False, targets=None
+    ):
+        unknown = [name for name in targets or [] if name not in self.plexes]
+
+        if unknown:
+            raise Exception(f"Unknown Plex target(s): {', '.join(unknown)}.")
+
+        plexes = [self.plexes[name] for name in targets or self.plexes]
+
+        logger.info(
+            f"Starting sync between Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_title}) "
+            f"on {', '.join(plex.target for plex in plexes)}."
+        )
+
+        with metrics.stage("plex_collection_id"):
+            plex_collection_ids = await asyncio.gather(
+                *[
+                    self._get_plex_collection_id(plex, plex_collection_title)
+                    for plex in plexes
+                ]
+            )
+
+        missing = [
+            plex.target
+            for plex, plex_collection_id in zip(plexes, plex_collection_ids)
+            if plex_collection_id == 0
+        ]
+
+        if missing:
+            raise Exception(
+                f"Unable to retrieve Plex collection ({', '.join(missing)})."
+            )
+
+        # Skip the targets where neither side changed since the last sync
+        with metrics.stage("change_check"):
+            try:
+                fingerprint, first_page = await self.letterboxd.get_fingerprint(
+                    letterboxd_list
+                )
+            except Exception as err:
+                logger.error(f"Unable to fingerprint Letterboxd list, exception: {err}")
+                fingerprint, first_page = None, None
+
+            plex_states = await asyncio.gather(
+                *[
+                    plex.get_collection_state(plex_collection_id)
+                    for plex, plex_collection_id in zip(plexes, plex_collection_ids)
+                ]
+            )
+
+        pending = []
+
+        for plex, plex_collection_id, plex_state in zip(
+            plexes, plex_collection_ids, plex_states
+        ):
+            if not force and self._is_unchanged(
+                letterboxd_list, plex, plex_collection_id, fingerprint, plex_state
+            ):
+                logger.info(
+                    f"Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_title}) "
+                    f"unchanged on {plex.target}, skipping sync."
+                )
+            else:
+                pending.append((plex, plex_collection_id))
+
+        if not pending:
+            return
+
+        # Pick up where an unfinished sync of the same list stopped. Plex
+        # operations are planned from the collection as it is now, so the ones
+        # applied aren't repeated, the journal skips crawled pages and Radarr adds.
+        journals = []
+
+        for plex, plex_collection_id in pending:
+            journal = Journal(
+                self.cache,
+                letterboxd_list,
+                plex.library,
+                plex_collection_id,
+                self.journal_max_age,
+            )
+
+            if journal.open(fingerprint):
+                logger.info(
+                    f"Resuming unfinished sync of Letterboxd list ({letterboxd_list}) on {plex.target}: "
+                    f"{len(journal.crawled_pages())} page(s) crawled and {len(journal.applied('radarr'))} Radarr add(s) applied"
+                )
+
+            journals.append(journal)
+
+        # Get TMDB ids from the Letterboxd list once for every target, and
+        # from each Plex collection while refreshing its library index for the
+        # adds, all at once. The crawled list pages go in the first journal,
+        # page 1 is the one fetched for the fingerprint.
+        logger.debug(
+            f"Parsing Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_title})"
+        )
+        letterboxd_ids, *plex_results = await asyncio.gather(
+            metrics.timed(
+                "letterboxd_list",
+                self.letterboxd.get_tmdb_ids(
+                    letterboxd_list, journals[0], first_page, force
+                ),
+            ),
+            *[
+                metrics.timed("plex_collection", plex.get_tmdb_ids(plex_collection_id))
+                for plex, plex_collection_id in pending
+            ],
+            *[self._refresh_plex_index(plex) for plex, _ in pending],
+        )
+
+        if letterboxd_ids is None:
+            raise Exception("Unable to retrieve Letterboxd list items.")
+
+        # Each target drops its own Radarr movies from the sort, so gets a copy
+        results = await asyncio.gather(
+            *[
+                self._sync_target(
+                    letterboxd_list,
+                    fingerprint,
+                    dict(letterboxd_ids),
+                    plex,
+                    plex_collection_id,
+                    plex_ids,
+                    journal,
+                )
+                for (plex, plex_collection_id), plex_ids, journal in zip(
+                    pending, plex_results, journals
+                )
+            ],
+            return_exceptions=True,
+        )
+
+        # One target failing doesn't stop the others
+        failed = []
+
+        for (plex, _), result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Failed to sync Plex ({plex.target}), exception: {result}"
+                )
+                failed.append(plex.target)
+
+        if failed:
+            raise Exception(f"Unable to sync Plex ({', '.join(failed)}).")
 
         logger.info(
-            f"Finished sync between Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_id})."
+            f"Finished sync between Letterboxd list ({letterboxd_list}) and Plex collection ({plex_collection_title}) "
+            f"on {', '.join(plex.target for plex, _ in pending)}."
         )
@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Path segments that are ids eg 123 or 1,2,3
+ID_SEGMENT = re.compile(r"\d+(,\d+)*")
+
+
+# Seconds since the process started, including interpreter start up and
+# imports. Read from /proc on Linux, elsewhere this module's import is the start.
+def _process_age():
+    try:
+        with open("/proc/self/stat", "r") as stat_file:
+            # Field 22, counted after the command name which may hold spaces
+            ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - ticks / os.sysconf(
+            "SC_CLK_TCK"
+        )
+    except Exception:
+        return 0.0
+
+
+# Path of a url with its ids replaced eg /library/metadata/{id}/matches
+def endpoint(url):
+    return "/".join(
+        "{id}" if ID_SEGMENT.fullmatch(segment) else segment
+        for segment in urlparse(url).path.split("/")
+    )
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+        self.count += 1
+        self.sum += value
+
+    def report(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "buckets": dict(
+                zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], self.buckets)
+            ),
+        }
+
+
+# Counters and timings of a process, shared by every job. Requests are made
+# from worker threads, so updates take a lock.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time() - _process_age()
+        self.first_requests = {}  # host, seconds from process start
+        self.stages = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+        self.requests = defaultdict(Histogram)  # (host, method, endpoint)
+        self.statuses = defaultdict(int)  # (host, status)
+        self.cache = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.browser_page_loads = Histogram()
+
+    # Time a stage of a sync eg with metrics.stage("letterboxd"): ...
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+
+            with self.lock:
+                self.stages[name]["count"] += 1
+                self.stages[name]["seconds"] += duration
+
+            logger.debug(f"Stage {name} took {duration:.3f}s")
+
+    # Await a coroutine as a stage, to time stages that run concurrently
+    async def timed(self, name, awaitable):
+        with self.stage(name):
+            return await awaitable
+
+    # Record a request, status None when it failed without a response
+    def observe_request(self, method, url, status, duration, path=None):
+        host = urlparse(url).netloc
+
+        with self.lock:
+            if host not in self.first_requests:
+                self.first_requests[host] = time.time() - duration - self.started_at
+
+            self.requests[(host, method, path or endpoint(url))].observe(duration)
+            self.statuses[(host, status or "error")] += 1
+
+    # Record a cache lookup of one key
+    def cache_lookup(self, method, hit):
+        with self.lock:
+            self.cache[method]["hits" if hit else "misses"] += 1
+
+    # Record a cache lookup of many keys, found is what the cache returned
+    def cache_lookups(self, method, keys, found):
+        with self.lock:
+            self.cache[method]["hits"] += len(found)
+            self.cache[method]["misses"] += len(keys) - len(found)
+
+    # Seconds from process start to the first request to the host of url
+    def first_request(self, url):
+        with self.lock:
+            return self.first_requests.get(urlparse(url).netloc)
+
+    def observe_browser_page_load(self, duration):
+        with self.lock:
+            self.browser_page_loads.observe(duration)
+
+    def report(self):
+        with self.lock:
+            return {
+                "started_at": int(self.started_at),
+                "duration": round(time.time() - self.started_at, 3),
+                # Start up time, until the first request to each host
+                "first_requests": {
+                    host: round(seconds, 3)
+                    for host, seconds in self.first_requests.items()
+                },
+                "stages": {
+                    name: {
+                        "count": stage["count"],
+                        "seconds": round(stage["seconds"], 6),
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "requests": [
+                    {
+                        "host": host,
+                        "method": method,
+                        "endpoint": path,
+                        **histogram.report(),
+                    }
+                    for (host, method, path), histogram in sorted(self.requests.items())
+                ],
+                "statuses": [
+                    {"host": host, "status": status, "count": count}
+                    for (host, status), count in sorted(self.statuses.items(), key=str)
+                ],
+                "cache": {
+                    method: dict(lookups) for method, lookups in self.cache.items()
+                },
+                "browser_page_loads": self.browser_page_loads.report(),
+            }
+
+    # Prometheus text exposition format, for the node exporter textfile collector
+    def prometheus(self):
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append(f"# HELP moviesync_{name} {help}")
+            lines.append(f"# TYPE moviesync_{name} {kind}")
+
+        def sample(name, value, **labels):
+            if labels:
+                pairs = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                name = f"{name}{{{pairs}}}"
+
+            lines.append(f"moviesync_{name} {value}")
+
+        def histogram(name, histogram, **labels):
+            cumulative = 0
+
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                sample(f"{name}_bucket", cumulative, **labels, le=bound)
+
+            sample(f"{name}_sum", histogram["sum"], **labels)
+            sample(f"{name}_count", histogram["count"], **labels)
+
+        metric("started_at_seconds", "gauge", "Start time of the process.")
+        sample("started_at_seconds", report["started_at"])
+
+        metric(
+            "first_request_seconds",
+            "gauge",
+            "Seconds from process start to the first request to each host.",
+        )
+        for host, seconds in report["first_requests"].items():
+            sample("first_request_seconds", seconds, host=host)
+
+        metric("stage_seconds_total", "counter", "Time spent in each sync stage.")
+        for name, stage in report["stages"].items():
+            sample("stage_seconds_total", stage["seconds"], stage=name)
+
+        metric("stage_runs_total", "counter", "Runs of each sync stage.")
+        for name, stage in report["stages"].items():
+            sample("stage_runs_total", stage["count"], stage=name)
+
+        metric(
+            "http_request_duration_seconds",
+            "histogram",
+            "Latency of HTTP requests per host and endpoint.",
+        )
+        for request in report["requests"]:
+            histogram(
+                "http_request_duration_seconds",
+                request,
+                host=request["host"],
+                method=request["method"],
+                endpoint=request["endpoint"],
+            )
+
+        metric("http_responses_total", "counter", "HTTP responses per host and status.")
+        for status in report["statuses"]:
+            sample(
+                "http_responses_total",
+                status["count"],
+                host=status["host"],
+                status=status["status"],
+            )
+
+        metric("cache_hits_total", "counter", "Keys found per cache query method.")
+        for method, lookups in report["cache"].items():
+            sample("cache_hits_total", lookups["hits"], method=method)
+
+        metric("cache_misses_total", "counter", "Keys missed per cache query method.")
+        for method, lookups in report["cache"].items():
+            sample("cache_misses_total", lookups["misses"], method=method)
+
+        metric(
+            "browser_page_load_seconds",
+            "histogram",
+            "Duration of pages loaded in the browser.",
+        )
+        histogram("browser_page_load_seconds", report["browser_page_loads"])
+
+        return "\n".join(lines) + "\n"
+
+    # Write the JSON run report and Prometheus textfile set under metrics in
+    # the config, each replaced atomically so readers never see half a file
+    def write(self, config):
+        metrics_config = config.get("metrics", {})
+
+        for path, content in (
+            (
+                metrics_config.get("report_file"),
+                lambda: json.dumps(self.report(), indent=4),
+            ),
+            (metrics_config.get("prometheus_file"), self.prometheus),
+        ):
+            if not path:
+                continue
+
+            try:
+                with open(f"{path}.tmp", "w") as metrics_file:
+                    metrics_file.write(content())
+
+                os.replace(f"{path}.tmp", path)
+            except Exception as err:
+                logger.error(f"Unable to write metrics to {path}, exception: {err}")
+
+
+metrics = Metrics()
@@ -1,55 +1,266 @@
+import asyncio
 import logging
+import time
 
 import lxml.etree
-import requests
 
 from moviesync import utils
+from moviesync.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
+# TMDB id from the Guid children of a Video element, None if unmatched
+def _parse_tmdb_guid(video):
+    for guid in video.iterfind("Guid"):
+        guid_id = guid.get("id", "")
+
+        if guid_id.startswith("tmdb://"):
+            return int(guid_id[len("tmdb://") :])
+
+    return None
+
+
+# Incrementally parse the Video elements of a response body with parse,
+# clearing each element once parsed so memory stays flat.
+# Returns the parsed videos and the total size of the container.
+def _parse_videos(body, parse):
+    videos = []
+    total = None
+
+    for event, element in lxml.etree.iterparse(body, events=("start", "end")):
+        if event == "start":
+            if element.tag == "MediaContainer":
+                total = int(element.get("totalSize", element.get("size", 0)))
+        elif element.tag == "Video":
+            videos.append(parse(element))
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    return videos, total
+
+
+# Plex servers and libraries to sync to, by name. The plex section is the
+# "default" target, each of plex.targets is another one overriding its
+# settings eg 4k: {movie_library_id: 2} for a second library on the server.
+def plex_targets(config):
+    plex_config = {
+        key: value for key, value in config["plex"].items() if key != "targets"
+    }
+
+    return {
+        "default": plex_config,
+        **{
+            name: {**plex_config, **(target or {})}
+            for name, target in (config["plex"].get("targets") or {}).items()
+        },
+    }
+
+
 class Plex:
-    def __init__(self, config, cache):
-        self.base_url = config["plex"]["url"]
-        self.x_plex_token = config["plex"]["token"]
-        self.library_id = config["plex"]["movie_library_id"]
+    def __init__(self, config, cache, client, target="default"):
+        plex_config = plex_targets(config)[target]
+
+        self.target = target
+        self.base_url = plex_config["url"]
+        self.x_plex_token = plex_config["token"]
+        self.library_id = plex_config["movie_library_id"]
+        # Cache key of the library, Plex ids are only valid within it
+        self.library = f"{self.base_url.rstrip('/')}/library/sections/{self.library_id}"
+        self.page_size = plex_config.get("page_size", 1000)
+        self.validate_batch_size = plex_config.get("validate_batch_size", 500)
+        # Items added to a collection per request, requests at a time and
+        # attempts per request
+        self.add_batch_size = plex_config.get("add_batch_size", 200)
+        self.add_concurrency = plex_config.get("add_concurrency", 1)
+        self.add_retries = plex_config.get("add_retries", 2)
         self.cache = cache
+        self.client = client
+        # Seconds a refreshed library index is trusted, for long running processes
+        self.library_index_ttl = plex_config.get("library_index_ttl", 300)
+        # TMDB ids not in this library
+        self.negative_kind = f"plex:{self.library}"
+        self.library_indexed_at = None
+        self.library_lock = asyncio.Lock()
+        self.machine_identifier = None
+
+    # Stream the Video elements of a paginated endpoint, one page per request
+    # of page_size items, yielding what parse returns for each of them
+    async def _iter_videos(self, path, params, parse, limit=None):
+        start = 0
+
+        while True:
+            page_params = {
+                "X-Plex-Container-Start": start,
+                "X-Plex-Container-Size": (
+                    self.page_size
+                    if limit is None
+                    else min(self.page_size, limit - start)
+                ),
+            }
+            page_params.update(params)
+
+            videos, total = await self.client.astream(
+                f"{self.base_url}{path}?X-Plex-Token={self.x_plex_token}{utils.parse_html_params(page_params)}",
+                lambda body: _parse_videos(body, parse),
+            )
+
+            for video in videos:
+                yield video
+
+            start += len(videos)
+
+            if (
+                not videos
+                or start >= (total or 0)
+                or (limit is not None and start >= limit)
+            ):
+                break
 
     # Get all rating keys based on filter
-    def _get_all_rating_keys(self, filters):
-        rating_keys = []
+    async def _get_all_rating_keys(self, filters):
+        return [
+            rating_key
+            async for rating_key in self._iter_videos(
+                f"/library/sections/{self.library_id}/all",
+                filters,
+                lambda video: int(video.get("ratingKey")),
+                filters.get("limit"),
+            )
+        ]
 
-        response = requests.get(
-            f"{self.base_url}/library/sections/{self.library_id}/all?X-Plex-Token={self.x_plex_token}{utils.parse_html_params(filters)}"
+    # Get the number of items in the library
+    async def _get_library_size(self):
+        response = await self.client.aget(
+            f"{self.base_url}/library/sections/{self.library_id}/all?X-Plex-Token={self.x_plex_token}&X-Plex-Container-Start=0&X-Plex-Container-Size=0"
         )
         response.raise_for_status()
 
         root = lxml.etree.fromstring(response.content)
 
-        for video in root.findall("Video"):
-            rating_keys.append(int(video.get("ratingKey")))
+        return int(root.get("totalSize", root.get("size", 0)))
+
+    # Enumerate library items page by page based on filter
+    # Yields rating key, TMDB id (None if unmatched) and last addedAt/updatedAt
+    async def _get_library_items(self, filters):
+        params = {"includeGuids": 1}
+        params.update(filters)
+
+        async for item in self._iter_videos(
+            f"/library/sections/{self.library_id}/all",
+            params,
+            lambda video: (
+                int(video.get("ratingKey")),
+                _parse_tmdb_guid(video),
+                max(int(video.get("addedAt", 0)), int(video.get("updatedAt", 0))),
+            ),
+        ):
+            yield item
+
+    # Films that show up in the library are no longer known to be missing
+    def _invalidate_negatives(self, items):
+        self.cache.remove_negatives(
+            self.negative_kind,
+            [tmdb_id for rating_key, tmdb_id, updated_at in items if tmdb_id],
+        )
+
+    # Store library items in the index a page at a time as they arrive, so
+    # memory doesn't grow with the library. Returns the number of items and
+    # their newest addedAt/updatedAt.
+    async def _index_library_items(self, filters):
+        count = 0
+        updated_at = 0
+        page = []
+
+        async for item in self._get_library_items(filters):
+            page.append(item)
+            count += 1
+            updated_at = max(updated_at, item[2])
+
+            if len(page) >= self.page_size:
+                self.cache.update_plex_library(self.library, page)
+                self._invalidate_negatives(page)
+                page = []
+
+        self.cache.update_plex_library(self.library, page)
+        self._invalidate_negatives(page)
+
+        return count, updated_at
+
+    # Build or incrementally refresh the TMDB id to rating key library index
+    async def refresh_library_index(self):
+        # Jobs share the index, only one of them refreshes it
+        async with self.library_lock:
+            with metrics.stage("plex_library_index"):
+                await self._refresh_library_index()
+
+    async def _refresh_library_index(self):
+        if (
+            self.library_indexed_at is not None
+            and time.monotonic() - self.library_indexed_at < self.library_index_ttl
+        ):
+            return
+
+        last_updated_at = self.cache.query_plex_library_state(self.library)
+
+        if last_updated_at is not None:
+            # Only items added or updated since the last refresh
+            count, updated_at = await self._index_library_items(
+                {"updatedAt>>": last_updated_at - 1}
+            )
+
+            self.cache.update_plex_library_state(
+                self.library, max(last_updated_at, updated_at)
+            )
+
+            logger.debug(f"Refreshed {count} item(s) in Plex library index")
+
+            # Removed items are not reported, rebuild if the counts disagree
+            full = (
+                self.cache.count_plex_library(self.library)
+                != await self._get_library_size()
+            )
+        else:
+            full = True
+
+        if full:
+            # Drops the index and its state, a rebuild cut short starts over
+            self.cache.clear_plex_library(self.library)
 
-        return rating_keys
+            count, updated_at = await self._index_library_items({})
 
-    # Get the machine identifier from the token
-    def _get_machine_identitier(self):
-        response = requests.get(
+            self.cache.update_plex_library_state(self.library, updated_at)
+
+            logger.debug(f"Rebuilt Plex library index with {count} item(s)")
+
+        self.library_indexed_at = time.monotonic()
+
+    # Get the machine identifier from the token, fetched once per run
+    async def _get_machine_identitier(self):
+        if self.machine_identifier is not None:
+            return self.machine_identifier
+
+        response = await self.client.aget(
             f"{self.base_url}/identity?X-Plex-Token={self.x_plex_token}"
         )
         response.raise_for_status()
 
         root = lxml.etree.fromstring(response.content)
 
-        return root.get("machineIdentifier")
+        self.machine_identifier = root.get("machineIdentifier")
+
+        return self.machine_identifier
 
     # Get the Plex server path from the machine identifier
-    def _get_server_path(self):
-        return f"server://{self._get_machine_identitier()}/com.plexapp.plugins.library"
+    async def _get_server_path(self):
+        return f"server://{await self._get_machine_identitier()}/com.plexapp.plugins.library"
 
     # Use the match hack to find a plex movie based on TMDB id
-    def _get_by_tmdbid(self, rating_key, tmdb_id):
+    async def _get_by_tmdbid(self, rating_key, tmdb_id):
         # https://forums.plex.tv/t/discover-future-movies/816009/7
-        response = requests.get(
+        response = await self.client.aget(
             f"{self.base_url}/library/metadata/{rating_key}/matches?X-Plex-Token={self.x_plex_token}&manual=1&title=tmdb-{tmdb_id}"
         )
         response.raise_for_status()
@@ -63,91 +274,333 @@ class Plex:
 
         return searchResult.get("guid")
 
-    # Add items to Plex collection based on tmdb id
-    def add_items(self, collection_id, tmdb_ids):
-        try:
-            dummy_rating_key = self._get_all_rating_keys({"limit": 1})[0]
-        except Exception as err:
-            logger.error(f"Unable to retrieve dummy rating key, exception: {err}")
+    # Find the Plex id of a TMDB id with the match hack, None if not in Plex
+    async def _find_plex_id(self, dummy_rating_key, tmdb_id):
+        plex_guid = await self._get_by_tmdbid(dummy_rating_key, tmdb_id)
+
+        if plex_guid is None:
+            return None
 
-            return None, None
+        rating_keys = await self._get_all_rating_keys({"guid": plex_guid})
 
-        in_plex = {}  # tmdb_id, plex_id, fromcache
+        if rating_keys:
+            return rating_keys[0]
+
+        return None
+
+    # Get which of the rating keys still exist in Plex, in batched requests
+    async def _get_existing_rating_keys(self, rating_keys):
+        rating_keys = sorted(rating_keys)
+        batches = [
+            rating_keys[i : i + self.validate_batch_size]
+            for i in range(0, len(rating_keys), self.validate_batch_size)
+        ]
+
+        existing = set()
+
+        for batch_existing in await asyncio.gather(
+            *[self._get_existing_rating_keys_batch(batch) for batch in batches]
+        ):
+            existing.update(batch_existing)
+
+        return existing
+
+    async def _get_existing_rating_keys_batch(self, rating_keys):
+        response = await self.client.aget(
+            f"{self.base_url}/library/metadata/{','.join(map(str, rating_keys))}?X-Plex-Token={self.x_plex_token}"
+        )
+
+        # None of them exist
+        if response.status_code == 404:
+            return set()
+
+        response.raise_for_status()
+
+        root = lxml.etree.fromstring(response.content)
+
+        return {int(video.get("ratingKey")) for video in root.findall("Video")}
+
+    # Add items to Plex collection based on tmdb id. Returns the items added,
+    # the TMDB ids not in Plex and the result of each chunk added.
+    async def add_items(self, collection_id, tmdb_ids):
+        dummy_rating_key = None
+
+        requested = list(tmdb_ids)
+        added = {}  # tmdb_id, plex_id
         not_in_plex = []  # tmdb_id
-        from_cache = []  # tmdb_id
+        validated = set()  # plex_id known to exist
+        revalidated = False
+        chunks = []
+
+        while True:
+            from_cache = []  # tmdb_id
+
+            try:
+                await self.refresh_library_index()
+            except Exception as err:
+                logger.error(f"Unable to refresh Plex library index, exception: {err}")
+
+            # Don't look if we know it's not there
+            candidates = [tmdb_id for tmdb_id in tmdb_ids if tmdb_id not in not_in_plex]
+
+            # Check cache first, in one query
+            cached = self.cache.query_plex_maps(self.library, candidates)
+            # Then the library index
+            indexed = self.cache.query_plex_library(
+                self.library,
+                [tmdb_id for tmdb_id in candidates if tmdb_id not in cached],
+            )
+            found = {}  # tmdb_id, plex_id
+            lookups = []  # tmdb_id
+            new_plex_maps = []
+
+            for tmdb_id in candidates:
+                plex_id = cached.get(tmdb_id)
+
+                if plex_id is not None:
+                    logger.debug(
+                        f"Found TMDB id {tmdb_id} for Plex id {plex_id} in cache"
+                    )
+                    found[tmdb_id] = plex_id
+                    from_cache.append(tmdb_id)
+                elif tmdb_id in indexed:
+                    plex_id = indexed[tmdb_id]
+                    new_plex_maps.append((tmdb_id, plex_id))
+                    logger.debug(
+                        f"Found TMDB id {tmdb_id} for Plex id {plex_id} in library index, added to cache"
+                    )
+                    found[tmdb_id] = plex_id
+                    from_cache.append(tmdb_id)
+                else:
+                    lookups.append(tmdb_id)
+
+            # Skip TMDB ids recently found not to be in Plex
+            known_missing = self.cache.query_negatives(self.negative_kind, lookups)
+
+            for tmdb_id in known_missing:
+                logger.debug(f"TMDB id {tmdb_id} not in Plex (cached)")
+                not_in_plex.append(tmdb_id)
+
+            lookups = [tmdb_id for tmdb_id in lookups if tmdb_id not in known_missing]
+            new_negatives = []
+
+            if lookups and dummy_rating_key is None:
+                try:
+                    rating_keys = await self._get_all_rating_keys({"limit": 1})
+                    dummy_rating_key = rating_keys[0]
+                except Exception as err:
+                    logger.error(
+                        f"Unable to retrieve dummy rating key, exception: {err}"
+                    )
+
+                    return None, None, chunks
+
+            # Not in cache or index, search Plex by TMDB id concurrently
+            results = await asyncio.gather(
+                *[self._find_plex_id(dummy_rating_key, tmdb_id) for tmdb_id in lookups],
+                return_exceptions=True,
+            )
+
+            for tmdb_id, plex_id in zip(lookups, results):
+                if isinstance(plex_id, Exception):
+                    logger.error(
+                        f"Unable to find Plex item (TMDB id: {tmdb_id}), exception: {plex_id}"
+                    )
+                elif plex_id is None:
+                    logger.debug(f"TMDB id {tmdb_id} not in Plex")
+                    not_in_plex.append(tmdb_id)
+                    new_negatives.append(tmdb_id)
+                else:
+                    new_plex_maps.append((tmdb_id, plex_id))
+                    logger.debug(
+                        f"Found TMDB id {tmdb_id} for Plex id {plex_id}, added to cache"
+                    )
+                    found[tmdb_id] = plex_id
+                    validated.add(plex_id)
+
+            self.cache.add_plex_maps(self.library, new_plex_maps)
+            self.cache.add_negatives(self.negative_kind, new_negatives)
 
-        retryCount = 2
+            # Check the cached Plex ids still exist, in one batched request
+            unchecked = {found[tmdb_id] for tmdb_id in from_cache} - validated
 
-        while retryCount > 0:
-            for tmdb_id in tmdb_ids:
+            if unchecked:
                 try:
-                    # Don't look if we know it's not there
-                    if tmdb_id in not_in_plex:
+                    existing = await self._get_existing_rating_keys(unchecked)
+                except Exception as err:
+                    logger.error(
+                        f"Unable to validate cached Plex ids, exception: {err}"
+                    )
+                    existing = unchecked
+
+                validated.update(existing)
+
+                stale = [
+                    tmdb_id
+                    for tmdb_id in from_cache
+                    if found[tmdb_id] in unchecked and found[tmdb_id] not in existing
+                ]
+
+                if stale:
+                    logger.debug(f"Removing {len(stale)} stale Plex id(s) from cache")
+
+                    # Invalidate only the stale cache items
+                    self.cache.remove_plex_maps(self.library, stale)
+                    self.cache.remove_plex_library_keys(
+                        self.library, [found[tmdb_id] for tmdb_id in stale]
+                    )
+                    self.library_indexed_at = None
+
+                    # Resolve them again, once
+                    if not revalidated:
+                        revalidated = True
                         continue
 
-                    # Check cache first
-                    tmdb_id, letterboxd_id, plex_id = self.cache.query_id_map(tmdb_id)
-
-                    if plex_id is None:
-                        # Not in cache, search Plex by TMDB id
-                        plex_guid = self._get_by_tmdbid(dummy_rating_key, tmdb_id)
-
-                        if plex_guid is not None:
-                            rating_keys = self._get_all_rating_keys({"guid": plex_guid})
-
-                            if rating_keys:
-                                plex_id = rating_keys[0]
-                                self.cache.add_id_map(tmdb_id, None, plex_id)
-                                logger.debug(
-                                    f"Found TMDB id {tmdb_id} for Plex id {plex_id}, added to cache"
-                                )
-                                in_plex[tmdb_id] = plex_id
-                            else:
-                                logger.debug(f"TMDB id {tmdb_id} not in Plex")
-                                not_in_plex.append(tmdb_id)
-                        else:
-                            logger.debug(f"TMDB id {tmdb_id} not in Plex")
-                            not_in_plex.append(tmdb_id)
-                    else:
-                        logger.debug(
-                            f"Found TMDB id {tmdb_id} for Plex id {plex_id} in cache"
-                        )
-                        in_plex[tmdb_id] = plex_id
-                        from_cache.append(tmdb_id)
+                    for tmdb_id in stale:
+                        del found[tmdb_id]
+
+            # Keep the requested order
+            in_plex = {
+                tmdb_id: found[tmdb_id] for tmdb_id in candidates if tmdb_id in found
+            }
+
+            chunks_added, stale = await self._add_in_chunks(
+                collection_id, in_plex, chunks
+            )
+            added.update(chunks_added)
+
+            # Gone from Plex since they were cached, resolve them again, once
+            if stale and not revalidated:
+                logger.debug(f"Resolving {len(stale)} stale Plex id(s) again")
+
+                revalidated = True
+                tmdb_ids = stale
+                continue
+
+            break
+
+        if not added:
+            return None, not_in_plex, chunks
+
+        return (
+            {tmdb_id: added[tmdb_id] for tmdb_id in requested if tmdb_id in added},
+            not_in_plex,
+            chunks,
+        )
+
+    # Add items to a collection in chunks of add_batch_size, up to
+    # add_concurrency at a time, so no PUT url grows past proxy limits.
+    # Returns the items added and the TMDB ids found stale, and appends the
+    # result of each chunk to chunks.
+    async def _add_in_chunks(self, collection_id, in_plex, chunks):
+        if not in_plex:
+            return {}, []
+
+        try:
+            server_path = await self._get_server_path()
+        except Exception as err:
+            logger.error(f"Unable to add Plex items, exception: {err}")
+            return {}, []
+
+        items = list(in_plex.items())
+        semaphore = asyncio.Semaphore(self.add_concurrency)
+
+        async def add_chunk(number, chunk):
+            async with semaphore:
+                return await self._add_chunk(collection_id, server_path, number, chunk)
+
+        added = {}
+        stale = []
+
+        for chunk_added, chunk_stale, result in await asyncio.gather(
+            *[
+                add_chunk(len(chunks) + n + 1, dict(items[i : i + self.add_batch_size]))
+                for n, i in enumerate(range(0, len(items), self.add_batch_size))
+            ]
+        ):
+            added.update(chunk_added)
+            stale.extend(chunk_stale)
+            chunks.append(result)
+
+        return added, stale
+
+    # Add one chunk of items, retried on its own. A failure only invalidates
+    # the cache entries of this chunk: Plex ids that no longer exist are
+    # dropped from it before the retry, and the whole chunk is forgotten if
+    # every attempt fails.
+    async def _add_chunk(self, collection_id, server_path, number, chunk):
+        started = time.perf_counter()
+        requested = len(chunk)
+        stale = []
+        attempts = 0
+        success = False
+
+        with metrics.stage("plex_add_chunk"):
+            # Retried here alone, not by the HTTP client too
+            while chunk and attempts <= self.add_retries:
+                attempts += 1
+
+                try:
+                    geturi = f"{server_path}/library/metadata/{','.join(map(str, chunk.values()))}"
+                    puturi = f"{self.base_url}/library/collections/{collection_id}/items?X-Plex-Token={self.x_plex_token}&uri={geturi}"
+
+                    response = await self.client.aput(puturi, retry=False)
+                    response.raise_for_status()
+
+                    success = True
+                    break
                 except Exception as err:
                     logger.error(
-                        f"Unable to find Plex item (TMDB id: {tmdb_id}), exception: {err}"
+                        f"Unable to add {len(chunk)} Plex item(s), attempt {attempts}, exception: {err}"
                     )
 
-            if not in_plex:
-                return None, not_in_plex
+                try:
+                    existing = await self._get_existing_rating_keys(chunk.values())
+                except Exception as err:
+                    logger.error(f"Unable to validate Plex ids, exception: {err}")
+                    continue
 
-            try:
-                geturi = f"{self._get_server_path()}/library/metadata/{','.join(map(lambda x: str(x), in_plex.values()))}"
-                puturi = f"{self.base_url}/library/collections/{collection_id}/items?X-Plex-Token={self.x_plex_token}&uri={geturi}"
+                chunk_stale = [
+                    tmdb_id
+                    for tmdb_id, plex_id in chunk.items()
+                    if plex_id not in existing
+                ]
 
-                response = requests.put(puturi)
-                response.raise_for_status()
+                if chunk_stale:
+                    logger.debug(
+                        f"Removing {len(chunk_stale)} stale Plex id(s) from cache"
+                    )
 
-                # Success, no need to retry
-                retryCount = 0
-            except Exception as err:
-                logger.error(f"Unable to add Plex items, exception: {err}")
+                    self.cache.remove_plex_maps(self.library, chunk_stale)
+                    self.cache.remove_plex_library_keys(
+                        self.library, [chunk[tmdb_id] for tmdb_id in chunk_stale]
+                    )
 
-                # Invalidate cache items
-                for tmdb_id in from_cache:
-                    self.cache.unset_plex_id(tmdb_id)
+                    stale.extend(chunk_stale)
 
-                in_plex = None
+                    for tmdb_id in chunk_stale:
+                        del chunk[tmdb_id]
 
-                logger.debug("Removed invalid items from cache, retry.")
+            if chunk and not success:
+                self.cache.remove_plex_maps(self.library, list(chunk))
 
-                retryCount -= 1
+        result = {
+            "chunk": number,
+            "items": requested,
+            "added": len(chunk) if success else 0,
+            "stale": len(stale),
+            "attempts": attempts,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
 
-        return in_plex, not_in_plex
+        logger.debug(
+            f"Chunk {number}: added {result['added']} of {requested} Plex item(s) in {result['seconds']}s, {attempts} attempt(s)"
+        )
+
+        return (chunk if success else {}), stale, result
 
     # Get collections, can filter by title.
-    def get_collection_ids(self, title):
+    async def get_collection_ids(self, title):
         rating_keys = []
 
         uri = f"{self.base_url}/library/sections/{self.library_id}/collections?X-Plex-Token={self.x_plex_token}"
@@ -157,7 +610,7 @@ class Plex:
             uri = f"{uri}{params}"
 
         try:
-            response = requests.get(uri)
+            response = await self.client.aget(uri)
             response.raise_for_status()
 
             root = lxml.etree.fromstring(response.content)
@@ -171,45 +624,84 @@ class Plex:
 
         return None
 
-    # Get TMDB ids from a Plex collection
-    def get_tmdb_ids(self, collection_id):
-        tmdb_ids = {}
-
+    # Get the last update time and number of items of a collection
+    async def get_collection_state(self, collection_id):
         try:
-            response = requests.get(
-                f"{self.base_url}/library/metadata/{collection_id}/children?X-Plex-Token={self.x_plex_token}&includeGuids=1"
+            response = await self.client.aget(
+                f"{self.base_url}/library/metadata/{collection_id}?X-Plex-Token={self.x_plex_token}"
             )
             response.raise_for_status()
 
             root = lxml.etree.fromstring(response.content)
 
-            for video in root.findall("Video"):
-                rating_key = int(video.get("ratingKey"))
+            directory = root.find("Directory")
 
-                # Check cache first
-                tmdb_id, plex_id = self.cache.query_id_map_by_plex(rating_key)
+            return int(directory.get("updatedAt", 0)), int(
+                directory.get("childCount", 0)
+            )
+        except Exception as err:
+            logger.error(f"Unable to get Plex collection state, exception: {err}")
 
-                if tmdb_id is None:
-                    guid = video.xpath("Guid[starts-with(@id, 'tmdb://')]")[0]
-                    tmdb_id = int(guid.get("id").replace("tmdb://", ""))
-                    self.cache.add_id_map(tmdb_id, None, rating_key)
-                    logger.debug(
-                        f"Found TMDB id {tmdb_id} for Plex id {rating_key}, added to cache"
-                    )
-                else:
-                    logger.debug(
-                        f"Found TMDB id {tmdb_id} for Plex id {rating_key} in cache"
-                    )
+        return None, None
+
+    # Get TMDB ids from a Plex collection
+    async def get_tmdb_ids(self, collection_id):
+        tmdb_ids = {}
+
+        try:
+            page = []
+
+            async for video in self._iter_videos(
+                f"/library/metadata/{collection_id}/children",
+                {"includeGuids": 1},
+                lambda video: (int(video.get("ratingKey")), _parse_tmdb_guid(video)),
+            ):
+                page.append(video)
 
-                tmdb_ids[tmdb_id] = rating_key
+                if len(page) >= self.page_size:
+                    self._add_collection_page(tmdb_ids, page)
+                    page = []
+
+            self._add_collection_page(tmdb_ids, page)
+
+            self.cache.remove_negatives(self.negative_kind, tmdb_ids.keys())
         except Exception as err:
             logger.error(f"Unable to parse Plex collection, generic exception: {err}")
             tmdb_ids = None
 
         return tmdb_ids
 
+    # Map a page of collection items (rating key, TMDB id from guid) to TMDB ids
+    def _add_collection_page(self, tmdb_ids, page):
+        # Check cache first, in one query
+        cached = self.cache.query_plex_maps_by_plex(
+            self.library, [rating_key for rating_key, _ in page]
+        )
+        new_plex_maps = []
+
+        for rating_key, guid_tmdb_id in page:
+            tmdb_id = cached.get(rating_key)
+
+            if tmdb_id is None:
+                if guid_tmdb_id is None:
+                    raise Exception(f"No TMDB id for Plex id {rating_key}")
+
+                tmdb_id = guid_tmdb_id
+                new_plex_maps.append((tmdb_id, rating_key))
+                logger.debug(
+                    f"Found TMDB id {tmdb_id} for Plex id {rating_key}, added to cache"
+                )
+            else:
+                logger.debug(
+                    f"Found TMDB id {tmdb_id} for Plex id {rating_key} in cache"
+                )
+
+            tmdb_ids[tmdb_id] = rating_key
+
+        self.cache.add_plex_maps(self.library, new_plex_maps)
+
     # Move an item within a collection
-    def move_item(self, collection_id, item_id, after_id):
+    async def move_item(self, collection_id, item_id, after_id):
         uri = f"{self.base_url}/library/collections/{collection_id}/items/{item_id}/move?X-Plex-Token={self.x_plex_token}"
 
         if after_id is not None:
@@ -217,7 +709,7 @@ class Plex:
             uri = f"{uri}{params}"
 
         try:
-            response = requests.put(uri)
+            response = await self.client.aput(uri)
             response.raise_for_status()
 
             return True
@@ -227,9 +719,9 @@ class Plex:
         return False
 
     # Remove an item from a Plex collection
-    def remove_item(self, collection_id, item_id):
+    async def remove_item(self, collection_id, item_id):
         try:
-            response = requests.delete(
+            response = await self.client.adelete(
                 f"{self.base_url}/library/collections/{collection_id}/items/{item_id}?X-Plex-Token={self.x_plex_token}"
             )
             response.raise_for_status()
@@ -1,35 +1,82 @@
+import asyncio
 import logging
-import requests
-from requests.exceptions import HTTPError
+import time
+from requests.exceptions import RequestException
 
 logger = logging.getLogger(__name__)
 
 class Radarr:
-    def __init__(self, config):
+    def __init__(self, config, client, cache):
         self.base_url = config['radarr']['url']
         self.api_key = config['radarr']['apikey']
         self.quality_profile = config['radarr']['quality_profile']
         self.root_folder_path = config['radarr']['root_folder_path']
+        # Seconds the movie library is reused, in memory and in the cache
+        self.library_ttl = config['radarr'].get('library_ttl', 3600)
+        self.batch_size = config['radarr'].get('batch_size', 50)
+        self.client = client
+        self.cache = cache
+        self.library = None  # tmdb_id
+        self.library_loaded_at = None
+        self.quality_profile_id = None
+        self.lock = asyncio.Lock()
 
-    # Get movie from Radarr based on TMDB id
-    def get_movie(self, tmdb_id):
-        try:
-            response = requests.get(f"{self.base_url}/api/v3/movie?apikey={self.api_key}&tmdbId={tmdb_id}")
-            response.raise_for_status()
-            
-            # If not found, empty array
-            return response.json()
-        except HTTPError as err:
-            logger.error(f"Could not get movie from Radarr: {err}")
-            
-        return None
-    
-    # Add movie to Radarr based on TMDB id
-    def add_movie(self, tmdb_id):
-        data = {
+    # Get the TMDB ids of every movie in Radarr, loaded once and reused for the TTL
+    async def get_library(self):
+        async with self.lock:
+            if self.library is not None and time.time() - self.library_loaded_at < self.library_ttl:
+                return self.library
+
+            tmdb_ids, loaded_at = self.cache.query_radarr_library(self.base_url)
+
+            if tmdb_ids is not None and time.time() - loaded_at < self.library_ttl:
+                logger.debug(f"Using cached Radarr library of {len(tmdb_ids)} movie(s)")
+            else:
+                try:
+                    response = await self.client.aget(f"{self.base_url}/api/v3/movie?apikey={self.api_key}")
+                    response.raise_for_status()
+                except RequestException as err:
+                    logger.error(f"Could not get movies from Radarr: {err}")
+
+                    return None
+
+                tmdb_ids = {movie['tmdbId'] for movie in response.json()}
+                loaded_at = int(time.time())
+
+                self.cache.update_radarr_library(self.base_url, tmdb_ids, loaded_at)
+                logger.debug(f"Loaded Radarr library of {len(tmdb_ids)} movie(s)")
+
+            self.library = tmdb_ids
+            self.library_loaded_at = loaded_at
+
+            return self.library
+
+    # Resolve the quality profile id once, the config can hold an id or a name
+    async def _get_quality_profile_id(self):
+        if self.quality_profile_id is not None:
+            return self.quality_profile_id
+
+        if str(self.quality_profile).isdigit():
+            self.quality_profile_id = int(self.quality_profile)
+
+            return self.quality_profile_id
+
+        response = await self.client.aget(f"{self.base_url}/api/v3/qualityprofile?apikey={self.api_key}")
+        response.raise_for_status()
+
+        for profile in response.json():
+            if profile['name'] == self.quality_profile:
+                self.quality_profile_id = profile['id']
+
+                return self.quality_profile_id
+
+        raise Exception(f"Unknown Radarr quality profile {self.quality_profile}")
+
+    def _movie(self, tmdb_id, quality_profile_id):
+        return {
             "tmdbId": tmdb_id,
             "monitored": True,
-            "qualityProfileId": self.quality_profile,
+            "qualityProfileId": quality_profile_id,
             "minimumAvailability": "announced",
             "addOptions": {
                 "searchForMovie": True
@@ -37,13 +84,62 @@ class Radarr:
             "rootFolderPath": self.root_folder_path,
             "title": f"tmdb-{tmdb_id}"
         }
-        
+
+    # Add movie to Radarr based on TMDB id
+    async def add_movie(self, tmdb_id):
         try:
-            response = requests.post(f"{self.base_url}/api/v3/movie?apikey={self.api_key}", json=data)
+            data = self._movie(tmdb_id, await self._get_quality_profile_id())
+
+            response = await self.client.apost(f"{self.base_url}/api/v3/movie?apikey={self.api_key}", json=data)
             response.raise_for_status()
-            
+
+            if self.library is not None:
+                self.library.add(tmdb_id)
+
             return response.json()
-        except HTTPError as err:
+        except Exception as err:
             logger.error(f"Could not add movie to Radarr: {err}")
-            
-        return None
\ No newline at end of file
+
+        return None
+
+    # Add a batch of movies with the import endpoint, one by one if it fails
+    async def _add_batch(self, tmdb_ids, quality_profile_id):
+        try:
+            data = [self._movie(tmdb_id, quality_profile_id) for tmdb_id in tmdb_ids]
+
+            response = await self.client.apost(f"{self.base_url}/api/v3/movie/import?apikey={self.api_key}", json=data)
+            response.raise_for_status()
+
+            added = {movie['tmdbId'] for movie in response.json()}
+        except RequestException as err:
+            logger.error(f"Could not add batch of {len(tmdb_ids)} movie(s) to Radarr, adding one by one: {err}")
+
+            results = await asyncio.gather(*[self.add_movie(tmdb_id) for tmdb_id in tmdb_ids])
+
+            return {tmdb_id: bool(result) for tmdb_id, result in zip(tmdb_ids, results)}
+
+        if self.library is not None:
+            self.library.update(added)
+
+        return {tmdb_id: tmdb_id in added for tmdb_id in tmdb_ids}
+
+    # Add movies to Radarr in batches, returns {tmdb_id: added}
+    async def add_movies(self, tmdb_ids):
+        try:
+            quality_profile_id = await self._get_quality_profile_id()
+        except Exception as err:
+            logger.error(f"Could not resolve Radarr quality profile: {err}")
+
+            return {tmdb_id: False for tmdb_id in tmdb_ids}
+
+        batches = [tmdb_ids[i:i + self.batch_size] for i in range(0, len(tmdb_ids), self.batch_size)]
+
+        results = {}
+
+        for batch in await asyncio.gather(*[self._add_batch(batch, quality_profile_id) for batch in batches]):
+            results.update(batch)
+
+        if self.library is not None:
+            self.cache.update_radarr_library(self.base_url, self.library, self.library_loaded_at)
+
+        return results
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# One request through a RateLimiter, mark it throttled on a challenge, a 429
+# or a timeout. Requests that end without an error count as successes.
+class Slot:
+    def __init__(self, started):
+        self.started = started
+        self.outcome = None
+
+    def throttled(self):
+        self.outcome = "throttled"
+
+
+# Paces requests to a host that throttles, eg Letterboxd. A token bucket
+# limits the request rate and an AIMD limit caps requests in flight. The rate
+# doubles after each round of successes until the first throttle (slow start)
+# and grows by one after that, the limit in flight grows by one. Both halve on
+# a throttle. Throttles of requests sent before the last back off are ignored,
+# they saw the old rate.
+class RateLimiter:
+    def __init__(self, name, rate, max_rate, min_rate, concurrency):
+        self.name = name
+        self.rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.slow_start_rate = max_rate  # lowered by the first throttle
+        self.max_concurrency = max(1, concurrency)
+        self.concurrency = float(self.max_concurrency)
+
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.successes = 0
+        self.backed_off_at = 0.0
+        self.backoffs = 0
+
+        self.lock = asyncio.Lock()  # waiters are served in order
+        self.released = asyncio.Event()
+
+    # Add the tokens earned since the last update, up to a second's worth
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    async def _acquire(self):
+        async with self.lock:
+            while True:
+                if self.in_flight >= int(self.concurrency):
+                    self.released.clear()
+                    await self.released.wait()
+                    continue
+
+                self._refill()
+
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    continue
+
+                self.tokens -= 1
+                self.in_flight += 1
+
+                return time.monotonic()
+
+    def _release(self, slot):
+        self.in_flight -= 1
+        self.released.set()
+
+        if slot.outcome == "throttled":
+            self._back_off(slot)
+        elif slot.outcome == "success":
+            self.successes += 1
+
+            # Roughly a second of requests without a throttle
+            if self.successes >= max(self.rate, self.concurrency):
+                self._ramp_up()
+
+    def _back_off(self, slot):
+        if slot.started < self.backed_off_at:
+            return
+
+        self.slow_start_rate = self.rate / 2
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.successes = 0
+        self.backed_off_at = time.monotonic()
+        self.backoffs += 1
+
+        logger.info(
+            f"{self.name} throttled, backing off to {self.rate:.1f} request(s)/s, {int(self.concurrency)} in flight"
+        )
+
+    def _ramp_up(self):
+        self.successes = 0
+
+        if self.rate < self.slow_start_rate:
+            self.rate = min(self.rate * 2, self.slow_start_rate)
+        else:
+            self.rate = min(self.rate + 1, self.max_rate)
+
+        self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+
+        logger.debug(
+            f"{self.name} rate up to {self.rate:.1f} request(s)/s, {int(self.concurrency)} in flight"
+        )
+
+    # Hold a slot for one request eg
+    # async with limiter.slot() as slot: ... slot.throttled()
+    @asynccontextmanager
+    async def slot(self):
+        slot = Slot(await self._acquire())
+
+        try:
+            yield slot
+
+            # Other errors say nothing about the rate
+            if slot.outcome is None:
+                slot.outcome = "success"
+        finally:
+            self._release(slot)
+
+    # Current pacing, for the run logs
+    def describe(self):
+        return (
+            f"{self.name} rate {self.rate:.1f} request(s)/s, {int(self.concurrency)} in flight, "
+            f"{self.backoffs} back off(s)"
+        )
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from moviesync.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Run one sync job, returns True on success
+async def run_job(letterboxdexport, job, force):
+    try:
+        await letterboxdexport.to_plex(
+            job["letterboxd_list"],
+            job["plex_collection"],
+            force,
+            job.get("plex_targets"),
+        )
+
+        return True
+    except Exception as err:
+        logger.error(
+            f"Failed to export from Letterboxd list ({job['letterboxd_list']}) to Plex collection ({job['plex_collection']}), exception: {err}"
+        )
+
+    return False
+
+
+class Scheduler:
+    def __init__(self, letterboxdexport, jobs, config):
+        sync_config = config.get("sync", {})
+
+        self.config = config
+        self.letterboxdexport = letterboxdexport
+        self.jobs = jobs
+        self.interval = sync_config.get("interval", 900)
+        self.jitter = sync_config.get("jitter", 60)
+        self.status_file = sync_config.get("status_file")
+        self.semaphore = asyncio.Semaphore(sync_config.get("parallelism", 1))
+        self.locks = {}  # plex_collection, lock
+        self.status = {}  # job name, last run details
+
+    def _name(self, job):
+        return f"{job['letterboxd_list']} -> {job['plex_collection']}"
+
+    # Write the last run details of every job to the status file
+    def _write_status(self):
+        if not self.status_file:
+            return
+
+        try:
+            with open(self.status_file, "w") as status_file:
+                json.dump(self.status, status_file, indent=4)
+        except Exception as err:
+            logger.error(f"Unable to write status file, exception: {err}")
+
+    # Run a job unless its collection is already being synced
+    async def _run(self, job, force):
+        name = self._name(job)
+        lock = self.locks.setdefault(job["plex_collection"], asyncio.Lock())
+
+        if lock.locked():
+            logger.info(f"Collection ({job['plex_collection']}) busy, skipping {name}")
+            return
+
+        async with lock, self.semaphore:
+            started = time.monotonic()
+            success = await run_job(self.letterboxdexport, job, force)
+            duration = time.monotonic() - started
+
+        self.status[name] = {
+            "last_run": int(time.time()),
+            "last_duration": round(duration, 3),
+            "last_success": success,
+        }
+        self._write_status()
+        metrics.write(self.config)
+
+        logger.info(
+            f"{'Succeeded' if success else 'Failed'}: {name} in {duration:.1f}s"
+        )
+
+    # Run a job forever, on its own interval with jitter
+    async def _loop(self, job, force):
+        interval = job.get("interval", self.interval)
+
+        # Stagger the first runs
+        await asyncio.sleep(random.uniform(0, self.jitter))
+
+        while True:
+            await self._run(job, force)
+            force = False
+
+            await asyncio.sleep(
+                max(0, interval + random.uniform(-self.jitter, self.jitter))
+            )
+
+    async def run(self, force=False):
+        logger.info(f"Scheduling {len(self.jobs)} sync job(s)")
+
+        await asyncio.gather(*[self._loop(job, force) for job in self.jobs])
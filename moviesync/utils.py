@@ -1,3 +1,4 @@
+from bisect import bisect_left
 from urllib.parse import quote
 
 def parse_html_params(args):
@@ -12,3 +13,46 @@ def parse_html_params(args):
         params = f"&{params}"
 
     return params
+
+# Plan the moves that reorder current into target order. Items in the longest
+# subsequence already in the right relative order stay put, every other item is
+# moved once, directly after its predecessor in target (None for the front).
+# Items missing from either list are ignored.
+def plan_moves(current, target):
+    current_set = set(current)
+    target = [item for item in target if item in current_set]
+    position = {item: i for i, item in enumerate(target)}
+    current = [item for item in current if item in position]
+
+    # Longest increasing subsequence of target positions, O(n log n)
+    tail_positions = []  # smallest tail position for each subsequence length
+    tail_indexes = []  # index in current of that tail
+    previous = [None] * len(current)
+
+    for i, item in enumerate(current):
+        length = bisect_left(tail_positions, position[item])
+
+        if length > 0:
+            previous[i] = tail_indexes[length - 1]
+
+        if length == len(tail_positions):
+            tail_positions.append(position[item])
+            tail_indexes.append(i)
+        else:
+            tail_positions[length] = position[item]
+            tail_indexes[length] = i
+
+    keep = set()
+    i = tail_indexes[-1] if tail_indexes else None
+
+    while i is not None:
+        keep.add(current[i])
+        i = previous[i]
+
+    moves = []
+
+    for i, item in enumerate(target):
+        if item not in keep:
+            moves.append((item, target[i - 1] if i > 0 else None))
+
+    return moves
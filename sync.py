@@ -1,16 +1,19 @@
+import argparse
 import asyncio
 import logging
 import sys
 
 from moviesync.cache import Cache
+from moviesync.client import HttpClient
 from moviesync.config import Config
 from moviesync.letterboxd import Letterboxd
 from moviesync.letterboxdexport import LetterboxdExport
-from moviesync.plex import Plex
+from moviesync.metrics import metrics
+from moviesync.plex import Plex, plex_targets
 from moviesync.radarr import Radarr
+from moviesync.scheduler import Scheduler, run_job
 
 logging.basicConfig(level=logging.INFO)
-logging.getLogger("moviesync").setLevel(logging.DEBUG)
 # logging.getLogger("requests").setLevel(logging.WARNING)
 # logging.getLogger("uc").setLevel(logging.WARNING)
 # logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -19,22 +22,122 @@ logging.getLogger("zendriver").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-# sync.py "<path_to_letterboxd_list>" "<name_of_plex_collection>"
+
+# Run sync jobs concurrently, sharing the browser, cache and HTTP clients
+async def sync(letterboxd, letterboxdexport, jobs, parallelism, force):
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run(job):
+        async with semaphore:
+            return await run_job(letterboxdexport, job, force)
+
+    try:
+        return await asyncio.gather(*[run(job) for job in jobs])
+    finally:
+        await letterboxd.close()
+
+
+# Run sync jobs on their intervals until stopped, keeping state warm
+async def daemon(letterboxd, letterboxdexport, jobs, config, force):
+    try:
+        await Scheduler(letterboxdexport, jobs, config).run(force)
+    finally:
+        await letterboxd.close()
+
+
+# sync.py [--force] [--daemon] [--targets <plex_target> ...] ["<path_to_letterboxd_list>" "<name_of_plex_collection>"]
+# Without a list and collection, runs the jobs configured in config.yml
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("letterboxd_list", nargs="?")
+    parser.add_argument("plex_collection", nargs="?")
+    parser.add_argument(
+        "--force", action="store_true", help="sync even if nothing changed"
+    )
+    parser.add_argument(
+        "--daemon", action="store_true", help="keep running jobs on their interval"
+    )
+    parser.add_argument(
+        "--targets",
+        nargs="+",
+        help="Plex targets to sync the list and collection to, default all",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="log every film, slows down big lists"
+    )
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger("moviesync").setLevel(logging.DEBUG)
+
+    config = Config.load()
+    cache = Cache(config)
+
+    if args.letterboxd_list and args.plex_collection:
+        jobs = [
+            {
+                "letterboxd_list": args.letterboxd_list,
+                "plex_collection": args.plex_collection,
+                "plex_targets": args.targets,
+            }
+        ]
+    elif args.letterboxd_list is None and config.get("jobs"):
+        jobs = config["jobs"]
+    else:
         logger.error("Invalid number of params")
         sys.exit(1)  # error
 
-    cache = Cache()
-    config = Config.load()
-    letterboxd = Letterboxd(cache)
-    plex = Plex(config, cache)
-    radarr = Radarr(config)
+    parallelism = config.get("sync", {}).get("parallelism", 1)
+
+    letterboxd = Letterboxd(config, cache)
+    client = HttpClient(config)
+    plexes = {
+        target: Plex(config, cache, client, target) for target in plex_targets(config)
+    }
+    radarr = Radarr(config, client, cache)
+
+    letterboxdexport = LetterboxdExport(letterboxd, plexes, radarr, cache, config)
 
-    letterboxdexport = LetterboxdExport(letterboxd, plex, radarr)
+    if args.daemon:
+        try:
+            asyncio.run(daemon(letterboxd, letterboxdexport, jobs, config, args.force))
+        except KeyboardInterrupt:
+            logger.info("Stopped")
+        finally:
+            client.close()
+
+        sys.exit(0)
 
     try:
-        asyncio.run(letterboxdexport.to_plex(sys.argv[1], sys.argv[2]))
-    except Exception as err:
-        logger.error(f"Failed to export from Letterboxd to Plex, exception: {err}")
+        results = asyncio.run(
+            sync(letterboxd, letterboxdexport, jobs, parallelism, args.force)
+        )
+    finally:
+        client.close()
+
+    for job, success in zip(jobs, results):
+        logger.info(
+            f"{'Succeeded' if success else 'Failed'}: {job['letterboxd_list']} -> {job['plex_collection']}"
+        )
+
+    metrics.write(config)
+
+    startup = metrics.first_request(config["plex"]["url"])
+
+    if startup is not None:
+        logger.info(f"Startup took {startup:.2f}s, until the first Plex request")
+
+    logger.info(
+        "Stage timings: "
+        + ", ".join(
+            f"{name} {stage['seconds']:.2f}s"
+            for name, stage in metrics.report()["stages"].items()
+        )
+    )
+
+    failed = results.count(False)
+
+    logger.info(f"{len(jobs) - failed} of {len(jobs)} sync job(s) succeeded")
+
+    if failed:
         sys.exit(1)  # error
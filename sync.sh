@@ -1,11 +1,7 @@
 #!/bin/sh
 
-rm -f /tmp/.X99-lock
-
-# Run Xvfb on display 0.
-Xvfb :99 -screen 0 1280x720x16 &
-
-export DISPLAY=:99
+# Xvfb is started on demand, only when a page needs the browser and
+# letterboxd.headless is off
 
 # Run python script
-python sync.py "$1" "$2"
\ No newline at end of file
+python sync.py "$@"
\ No newline at end of file